@@ -1,10 +1,62 @@
 # Import necessary libraries and modules
 from functools import wraps
-from datetime import datetime
-from flask import Flask, render_template, redirect, request, url_for, flash, session, send_file
+from array import array
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from flask import Flask, Request, render_template, redirect, request, url_for, flash, session, send_from_directory, g, jsonify, Response, stream_with_context, has_request_context, before_render_template, template_rendered
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
+from itertools import accumulate, chain
+from jinja2 import FileSystemBytecodeCache, pass_context
+from markupsafe import Markup
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join, DEFAULT_PBKDF2_ITERATIONS
+import atexit
+import bisect
+import click
+import csv
+import hashlib
+import importlib.util
+import io
+import json
+import mimetypes
+import mmap
 import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import struct
+import tempfile
+import threading
+import time
+import wave
+import zlib
+
+# orjson is used for the JSON API when installed, the standard library otherwise
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+# mutagen reads the metadata of uploaded audio when installed, only WAV files are read otherwise
+try:
+  import mutagen
+except ImportError:
+  mutagen = None
+
+# numpy and scipy compute the similar songs lists when installed, the lists stay empty otherwise.
+# They are imported on first use, so worker startup doesn't pay for them
+similar_available = importlib.util.find_spec('numpy') is not None and importlib.util.find_spec('scipy') is not None
+
+# Pillow optimizes images in the asset build when installed, images are copied as they are otherwise.
+# Only flask build-assets needs it, so it is imported there
+pillow_available = importlib.util.find_spec('PIL') is not None
 
 # Create a Flask application
 app=Flask(__name__)
@@ -13,9 +65,135 @@ app=Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI']='sqlite:///db.sqlite3'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = "thisisasecretkey"
-
-# Initialize a SQLAlchemy database
-db=SQLAlchemy(app)
+# maximum number of ranked matches returned by the searchbar
+app.config['SEARCH_LIMIT'] = 100
+# most typeahead suggestions returned per keystroke
+app.config['SUGGEST_LIMIT'] = 10
+# number of rows shown per page on listing pages
+app.config['PAGE_SIZE'] = 20
+# seconds the isadmin / iscreator flags of a user are cached in process, 0 disables the cache
+app.config['ROLE_CACHE_TTL'] = 0
+# password hashing runs in a pool of worker processes, 0 workers hashes on the request thread
+app.config['PASSWORD_HASH_METHOD'] = 'scrypt'
+app.config['HASH_WORKERS'] = 2
+# hashing jobs allowed in flight per worker before new logins are turned away
+app.config['HASH_QUEUE_DEPTH'] = 16
+# memory cap for cached rendered catalog fragments, in characters
+app.config['FRAGMENT_CACHE_SIZE'] = 16 * 1024 * 1024
+# catalog changes kept for the in memory catalog snapshots of the workers, a worker further behind reads the whole
+# catalog again, as does a change touching more albums than the patch limit
+app.config['CATALOG_LOG_SIZE'] = 10000
+app.config['CATALOG_PATCH_LIMIT'] = 500
+# folder song audio paths are relative to
+app.config['MEDIA_FOLDER'] = os.path.join(app.instance_path, 'media')
+# folder song lyrics paths are relative to, and an optional packed archive checked first
+app.config['LYRICS_FOLDER'] = os.path.join(app.instance_path, 'lyrics')
+app.config['LYRICS_ARCHIVE'] = None
+# memory cap for cached lyrics, in characters
+app.config['LYRICS_CACHE_SIZE'] = 4 * 1024 * 1024
+# largest accepted song upload request, in bytes
+app.config['MAX_UPLOAD_SIZE'] = 64 * 1024 * 1024
+# threads reading the duration of uploaded audio after the response, 0 reads it on the request thread
+app.config['MEDIA_WORKERS'] = 2
+# unreferenced blobs removed per garbage collection batch
+app.config['BLOB_GC_BATCH'] = 100
+# similar songs kept per song, and songs whose similarities are computed in one sparse product
+app.config['SIMILAR_TOP_K'] = 10
+app.config['SIMILAR_BLOCK'] = 2000
+# play events are buffered in memory and written in one transaction every few seconds,
+# a crash loses at most that many seconds of plays, a full buffer drops the oldest events
+app.config['PLAY_BUFFER_SIZE'] = 100000
+app.config['PLAY_FLUSH_SECONDS'] = 5
+# entries per top chart
+app.config['CHART_SIZE'] = 20
+# shared file of page versions behind the ETag / Last-Modified headers of the catalog and playlist pages
+app.config['VERSION_FILE'] = os.path.join(app.instance_path, 'versions.bin')
+# output of flask build-assets, fingerprinted files served with year long immutable caching
+app.config['ASSET_FOLDER'] = os.path.join(app.instance_path, 'assets')
+# HTML and JSON responses at least this many bytes (or streamed) are gzipped for clients that accept it
+app.config['GZIP_MIN_SIZE'] = 1024
+app.config['GZIP_LEVEL'] = 6
+# SQLite engine profile, pragmas run on every new connection
+app.config['SQLITE_PRAGMAS'] = {
+  'journal_mode': 'WAL',
+  'synchronous': 'NORMAL',
+  'cache_size': -64000,
+  'mmap_size': 256 * 1024 * 1024,
+  'busy_timeout': 5000,
+}
+# connections pooled per worker process
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_size': 5, 'max_overflow': 5}
+# attempts for a short write transaction that finds the database locked
+app.config['WRITE_RETRIES'] = 5
+# per request SQL and template timing for the admin performance panel, nothing is hooked in when off
+app.config['METRICS_ENABLED'] = True
+# statements slower than this many milliseconds go to the slow query log
+app.config['SLOW_QUERY_MS'] = 100
+# latest requests per endpoint kept for the latency histogram
+app.config['METRICS_WINDOW'] = 1000
+# compiled templates are kept here across restarts, filled by flask compile-templates, None compiles in memory only
+app.config['TEMPLATE_CACHE_FOLDER'] = os.path.join(app.instance_path, 'jinja_cache')
+# the first request of each worker creates or upgrades the schema when it is out of date, off leaves that to flask init-db
+app.config['AUTO_INIT_DB'] = True
+# any setting can be overridden with an AMPLIFI_<NAME> environment variable, values are parsed as JSON
+app.config.from_prefixed_env('AMPLIFI')
+
+# Define a SQLAlchemy database, bound to the app by create_app
+db=SQLAlchemy()
+
+# Apply the SQLite engine profile to each pooled connection
+def set_sqlite_pragmas(connection, record):
+  cursor = connection.cursor()
+  for name, value in app.config['SQLITE_PRAGMAS'].items():
+    cursor.execute('PRAGMA ' + name + ' = ' + str(value))
+  cursor.close()
+
+# Raised when the hashing pool is at its queue depth
+class HashPoolBusy(Exception):
+  pass
+
+# Bounded process pool for password hashing, created on first use in each worker
+hash_pool = None
+hash_slots = None
+hash_pool_lock = threading.Lock()
+
+def run_hash_job(func, *args):
+  global hash_pool, hash_slots
+  if not app.config['HASH_WORKERS']:
+    return func(*args)
+  with hash_pool_lock:
+    if hash_pool is None:
+      hash_pool = ProcessPoolExecutor(max_workers=app.config['HASH_WORKERS'])
+      hash_slots = threading.BoundedSemaphore(app.config['HASH_QUEUE_DEPTH'])
+  # backpressure, refuse instead of queueing without bound
+  if not hash_slots.acquire(blocking=False):
+    raise HashPoolBusy()
+  try:
+    return hash_pool.submit(func, *args).result()
+  finally:
+    hash_slots.release()
+
+def hash_password(password):
+  return run_hash_job(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'])
+
+def verify_password(passhash, password):
+  return run_hash_job(check_password_hash, passhash, password)
+
+# Method prefix of a hash, with werkzeug's defaults filled in for parameters the method leaves out
+def hash_method_prefix(method):
+  parts = method.split(':')
+  defaults = {'scrypt': ['scrypt', str(2 ** 15), '8', '1'], 'pbkdf2': ['pbkdf2', 'sha256', str(DEFAULT_PBKDF2_ITERATIONS)]}.get(parts[0], [])
+  return ':'.join(parts + defaults[len(parts):])
+
+# Whether a stored hash was made with other parameters than the configured method
+def password_needs_rehash(passhash):
+  return passhash.split('$', 1)[0] != hash_method_prefix(app.config['PASSWORD_HASH_METHOD'])
+
+# Send the client back to the form it posted when the hashing pool is saturated
+@app.errorhandler(HashPoolBusy)
+def hash_pool_busy(error):
+  flash('Server is busy, please try again in a moment.')
+  return redirect(request.path)
 
 # Define the User model for the database
 class User(db.Model):
@@ -47,19 +225,23 @@ class Song(db.Model):
     __tablename__ = 'song'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     songname = db.Column(db.String(50), nullable=False)
-    album_id = db.Column(db.Integer, db.ForeignKey('album.id'), nullable=False)
+    album_id = db.Column(db.Integer, db.ForeignKey('album.id'), nullable=False, index=True)
     # storing file path instead of actual file
     songlyrics_path = db.Column(db.String(255), nullable=True)
+    songaudio_path = db.Column(db.String(255), nullable=True)
     songduration = db.Column(db.Time, nullable=False)
+    # read from the uploaded audio file by the metadata workers
+    songbitrate = db.Column(db.Integer, nullable=True)
+    songsamplerate = db.Column(db.Integer, nullable=True)
     songdateofcreation = db.Column(db.Date, nullable=False)
-    playlists = db.relationship('Playlist', backref='song', lazy=True)
+    playlist_songs = db.relationship('PlaylistSong', backref='song', lazy=True, cascade='all, delete-orphan')
 
 # Define the Album model for the database
 class Album(db.Model):
   __tablename__ = 'album'
   id = db.Column(db.Integer, primary_key=True, autoincrement=True)
   albumname = db.Column(db.String(50), nullable=False)
-  albumgenre = db.Column(db.String(50), db.ForeignKey('genre.genrename'), nullable=False)
+  albumgenre = db.Column(db.String(50), db.ForeignKey('genre.genrename'), nullable=False, index=True)
   albumartist = db.Column(db.String(50), nullable=False)
   albumnoofsongs = db.Column(db.Integer, nullable=False, default=0)
   songs  = db.relationship('Song', backref='album', lazy=True)
@@ -68,25 +250,1033 @@ class Album(db.Model):
 class Genre(db.Model):
   __tablename__ = 'genre'
   id = db.Column(db.Integer, primary_key=True)
-  genrename = db.Column(db.String(50), nullable=False)
+  genrename = db.Column(db.String(50), nullable=False, unique=True)
   albums = db.relationship('Album', backref='genre', lazy=True)
 
 # Define the Playlist model for the database
 class Playlist(db.Model):
     __tablename__ = 'playlist'
-    userid = db.Column(db.Integer, db.ForeignKey('user.id'), unique=False, nullable=False)
-    songid = db.Column(db.Integer, db.ForeignKey('song.id'), primary_key=True, nullable=False)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    userid = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    name = db.Column(db.String(50), nullable=False)
+    songs = db.relationship('PlaylistSong', backref='playlist', lazy=True, cascade='all, delete-orphan')
+
+# Define the PlaylistSong model for the database
+# positions are spaced by playlist_gap so moving a song only rewrites that song's row
+class PlaylistSong(db.Model):
+    __tablename__ = 'playlist_song'
+    playlistid = db.Column(db.Integer, db.ForeignKey('playlist.id'), primary_key=True)
+    songid = db.Column(db.Integer, db.ForeignKey('song.id'), primary_key=True, index=True)
+    position = db.Column(db.Integer, nullable=False)
+    __table_args__ = (db.Index('ix_playlist_song_position', 'playlistid', 'position'),)
+
+playlist_gap = 1024
+
+# Define the Stat model for the database
+# running totals for the admin dashboard, updated in the same transaction as the rows they count
+class Stat(db.Model):
+    __tablename__ = 'stat'
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+# Define the SimilarSong model for the database
+# precomputed songs saved by the same listeners, rank 0 is the closest
+class SimilarSong(db.Model):
+    __tablename__ = 'similar_song'
+    songid = db.Column(db.Integer, db.ForeignKey('song.id'), primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True)
+    similarid = db.Column(db.Integer, db.ForeignKey('song.id'), nullable=False, index=True)
+    score = db.Column(db.Float, nullable=False)
+
+# Define the SimilarDirty model for the database
+# songs whose similar songs are out of date, version goes up each time a song is marked again
+class SimilarDirty(db.Model):
+    __tablename__ = 'similar_dirty'
+    songid = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    # set when the song joined or left a library, the refresh then marks the lists its new listener count moves
+    changed = db.Column(db.Boolean, nullable=True)
+
+# Define the SongPlays, AlbumPlays and GenrePlays models for the database
+# play counts rolled up into hour and day buckets, bucket is the unix time the period starts at
+class SongPlays(db.Model):
+    __tablename__ = 'song_plays'
+    period = db.Column(db.String(4), primary_key=True)
+    bucket = db.Column(db.Integer, primary_key=True)
+    songid = db.Column(db.Integer, db.ForeignKey('song.id'), primary_key=True)
+    plays = db.Column(db.Integer, nullable=False, default=0)
+
+class AlbumPlays(db.Model):
+    __tablename__ = 'album_plays'
+    period = db.Column(db.String(4), primary_key=True)
+    bucket = db.Column(db.Integer, primary_key=True)
+    albumid = db.Column(db.Integer, db.ForeignKey('album.id'), primary_key=True)
+    plays = db.Column(db.Integer, nullable=False, default=0)
+
+class GenrePlays(db.Model):
+    __tablename__ = 'genre_plays'
+    period = db.Column(db.String(4), primary_key=True)
+    bucket = db.Column(db.Integer, primary_key=True)
+    genrename = db.Column(db.String(50), db.ForeignKey('genre.genrename'), primary_key=True)
+    plays = db.Column(db.Integer, nullable=False, default=0)
+
+# Define the Blob model for the database
+# one row per file of the content addressed store, refcount is the number of song paths naming it
+class Blob(db.Model):
+    __tablename__ = 'blob'
+    kind = db.Column(db.String(10), primary_key=True)
+    path = db.Column(db.String(255), primary_key=True)
+    size = db.Column(db.Integer, nullable=False, default=0)
+    refcount = db.Column(db.Integer, nullable=False, default=0, index=True)
+
+# Define the CatalogChange model for the database
+# log of catalog changes the in memory snapshots catch up from, 'album' reloads the album and its songs,
+# 'genres' the genre list and 'all' the whole catalog
+class CatalogChange(db.Model):
+    __tablename__ = 'catalog_change'
+    seq = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(10), nullable=False)
+    albumid = db.Column(db.Integer, nullable=True)
+
+# Versions of the catalog and of each user's pages, shared by the worker processes through a small mmap'd file
+# so conditional requests are answered without the database. A version is the time_ns of the last change,
+# names hash onto a fixed number of slots, a collision only costs a spurious miss
+class VersionFile:
+  slots = 65536
+  header = struct.Struct('<8sQ')
+
+  def __init__(self, path):
+    size = self.header.size + self.slots * 8
+    if not os.path.exists(path):
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      # a new file gets a new random epoch, so tags handed out before it was (re)created never match
+      with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(path), delete=False) as f:
+        f.write(self.header.pack(os.urandom(8), time.time_ns()))
+        f.truncate(size)
+      try:
+        os.link(f.name, path)
+      except FileExistsError:
+        pass
+      os.remove(f.name)
+    with open(path, 'r+b') as f:
+      self.map = mmap.mmap(f.fileno(), size)
+    epoch, self.created = self.header.unpack_from(self.map)
+    self.epoch = epoch.hex()
+
+  def offset(self, name):
+    return self.header.size + zlib.crc32(name.encode()) % self.slots * 8
+
+  def get(self, name):
+    return struct.unpack_from('<Q', self.map, self.offset(name))[0] or self.created
+
+  def bump(self, name):
+    struct.pack_into('<Q', self.map, self.offset(name), time.time_ns())
+
+page_versions = None
+
+def get_page_versions():
+  global page_versions
+  if page_versions is None:
+    page_versions = VersionFile(app.config['VERSION_FILE'])
+  return page_versions
+
+# Mark a page version as changed, once the current transaction commits so no one caches the old rows under the new version
+def mark_changed(name):
+  if db.session().in_transaction():
+    db.session.info.setdefault('changed', set()).add(name)
+  else:
+    get_page_versions().bump(name)
+
+@event.listens_for(db.session, 'after_commit')
+def bump_changed(session):
+  for name in session.info.pop('changed', ()):
+    get_page_versions().bump(name)
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_changed(session):
+  session.info.pop('changed', None)
+
+# Count queries used to seed the stat counters
+stat_counts = {
+    'users': lambda: User.query.count(),
+    'creators': lambda: User.query.filter_by(iscreator=True).count(),
+    'songs': lambda: Song.query.count(),
+    'albums': lambda: Album.query.count(),
+    'genres': lambda: Genre.query.count(),
+    'plays': lambda: db.session.execute(db.select(db.func.coalesce(db.func.sum(SongPlays.plays), 0)).where(SongPlays.period == 'day')).scalar(),
+}
+
+# Seed any missing stat counters from COUNT aggregates
+def seed_stats():
+  for name, count in stat_counts.items():
+    if not db.session.get(Stat, name):
+      db.session.add(Stat(name=name, value=count()))
+  db.session.commit()
+
+# Adjust a stat counter within the current transaction
+def bump_stat(name, delta=1):
+  db.session.execute(db.update(Stat).where(Stat.name == name).values(value=Stat.value + delta))
+
+# Read all stat counters
+def get_stats():
+  return {stat.name: stat.value for stat in Stat.query.all()}
+
+# Mark the catalog as changed within the current transaction, album_ids are the albums whose row or songs changed
+def bump_catalog(*album_ids, genres=False):
+  album_ids = set(album_ids)
+  if len(album_ids) > app.config['CATALOG_PATCH_LIMIT']:
+    changes = [{'kind': 'all', 'albumid': None}]
+  else:
+    changes = [{'kind': 'album', 'albumid': id} for id in sorted(album_ids)]
+    if genres:
+      changes.append({'kind': 'genres', 'albumid': None})
+  if changes:
+    db.session.execute(db.insert(CatalogChange), changes)
+    # the log only has to reach back as far as the slowest worker's snapshot
+    last = db.select(db.func.max(CatalogChange.seq)).scalar_subquery()
+    db.session.execute(db.delete(CatalogChange).where(CatalogChange.seq <= last - app.config['CATALOG_LOG_SIZE']))
+  mark_changed('catalog')
+
+# LRU cache of rendered catalog fragments, (catalog snapshot seq, endpoint, query string) -> html
+fragment_cache = OrderedDict()
+fragment_cache_size = 0
+fragment_lock = threading.Lock()
+
+# Rendered fragment for the current request, render() only runs on a cache miss
+def cached_fragment(render):
+  global fragment_cache_size
+  key = (catalog_snapshot().seq, request.endpoint, tuple(sorted(request.args.items(multi=True))))
+  with fragment_lock:
+    html = fragment_cache.get(key)
+    if html is not None:
+      fragment_cache.move_to_end(key)
+      return html
+  html = Markup(render())
+  with fragment_lock:
+    if key not in fragment_cache:
+      fragment_cache[key] = html
+      fragment_cache_size += len(html)
+    # evict least recently used fragments over the memory cap
+    while fragment_cache_size > app.config['FRAGMENT_CACHE_SIZE'] and fragment_cache:
+      fragment_cache_size -= len(fragment_cache.popitem(last=False)[1])
+  return html
+
+# Full text search index over songs and albums (SQLite FTS5), rowid is the song / album id
+search_tables = {
+  'song_search': "CREATE VIRTUAL TABLE song_search USING fts5(songname, albumname, albumartist, genrename, prefix='2 3', tokenize='unicode61 remove_diacritics 2')",
+  'album_search': "CREATE VIRTUAL TABLE album_search USING fts5(albumname, albumartist, genrename, prefix='2 3', tokenize='unicode61 remove_diacritics 2')",
+}
+song_search_insert = '''INSERT INTO song_search(rowid, songname, albumname, albumartist, genrename)
+  SELECT song.id, song.songname, album.albumname, album.albumartist, album.albumgenre FROM song JOIN album ON album.id = song.album_id'''
+album_search_insert = '''INSERT INTO album_search(rowid, albumname, albumartist, genrename)
+  SELECT album.id, album.albumname, album.albumartist, album.albumgenre FROM album'''
+
+# Create the search tables if missing, returns True when any had to be created
+def create_search_index():
+  existing = {row[0] for row in db.session.execute(db.text("SELECT name FROM sqlite_master WHERE type = 'table'"))}
+  created = False
+  for name, ddl in search_tables.items():
+    if name not in existing:
+      db.session.execute(db.text(ddl))
+      created = True
+  db.session.commit()
+  return created
+
+# Repopulate the search tables from the catalog
+def rebuild_search_index():
+  db.session.execute(db.text('DELETE FROM song_search'))
+  db.session.execute(db.text('DELETE FROM album_search'))
+  db.session.execute(db.text(song_search_insert))
+  db.session.execute(db.text(album_search_insert))
+  db.session.commit()
 
-# Ensure the database tables are created
-with app.app_context():
+# Refresh the search entry of a song within the current transaction
+def index_song(id):
+  db.session.flush()
+  unindex_song(id)
+  db.session.execute(db.text(song_search_insert + ' WHERE song.id = :id'), {'id': id})
+
+def unindex_song(id):
+  db.session.execute(db.text('DELETE FROM song_search WHERE rowid = :id'), {'id': id})
+
+# Refresh the search entries of an album and its songs within the current transaction
+def index_album(id):
+  db.session.flush()
+  unindex_album(id)
+  db.session.execute(db.text(album_search_insert + ' WHERE album.id = :id'), {'id': id})
+  db.session.execute(db.text(song_search_insert + ' WHERE song.album_id = :id'), {'id': id})
+
+def unindex_album(id):
+  db.session.execute(db.text('DELETE FROM album_search WHERE rowid = :id'), {'id': id})
+  db.session.execute(db.text('DELETE FROM song_search WHERE rowid IN (SELECT id FROM song WHERE album_id = :id)'), {'id': id})
+
+# Ranked ids matching every word of the search as a prefix
+def search_ids(table, search):
+  words = re.findall(r'\w+', search)
+  if not words:
+    return []
+  query = ' '.join('"' + word + '"*' for word in words)
+  rows = db.session.execute(db.text('SELECT rowid FROM ' + table + ' WHERE ' + table + ' MATCH :query ORDER BY rank LIMIT :limit'), {'query': query, 'limit': app.config['SEARCH_LIMIT']})
+  return [row[0] for row in rows]
+
+# Rebuild the search index of an existing database
+@app.cli.command('rebuild-search')
+def rebuild_search_command():
+  create_search_index()
+  rebuild_search_index()
+  click.echo('Search index rebuilt.')
+
+# Packed lyrics archive: header, index of (song id, offset, length) sorted by song id, zlib compressed lyrics
+class LyricsArchive:
+  magic = b'LYR1'
+  header = struct.Struct('<4sQ')
+  record = struct.Struct('<QQQ')
+
+  def __init__(self, path):
+    self.file = open(path, 'rb')
+    self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, self.count = self.header.unpack_from(self.data, 0)
+    if magic != self.magic:
+      raise ValueError('Not a lyrics archive: ' + path)
+
+  def song_id(self, i):
+    return self.record.unpack_from(self.data, self.header.size + i * self.record.size)[0]
+
+  # binary search of the mapped index, only the touched pages are read from disk
+  def get(self, song_id):
+    i = bisect.bisect_left(range(self.count), song_id, key=self.song_id)
+    if i == self.count:
+      return None
+    id, offset, length = self.record.unpack_from(self.data, self.header.size + i * self.record.size)
+    if id != song_id:
+      return None
+    return zlib.decompress(self.data[offset:offset + length]).decode('utf-8')
+
+  # write an archive from (song id, lyrics) pairs in increasing song id order
+  @classmethod
+  def write(cls, path, lyrics):
+    index = []
+    with tempfile.TemporaryFile() as blobs:
+      for song_id, text in lyrics:
+        blob = zlib.compress(text.encode('utf-8'))
+        index.append((song_id, blobs.tell(), len(blob)))
+        blobs.write(blob)
+      start = cls.header.size + len(index) * cls.record.size
+      blobs.seek(0)
+      with open(path, 'wb') as out:
+        out.write(cls.header.pack(cls.magic, len(index)))
+        for song_id, offset, length in index:
+          out.write(cls.record.pack(song_id, start + offset, length))
+        shutil.copyfileobj(blobs, out)
+    return len(index)
+
+lyrics_archive = None
+
+# Read a loose lyrics file through mmap
+def read_lyrics_file(path):
+  path = safe_join(app.config['LYRICS_FOLDER'], path)
+  if not path or not os.path.isfile(path):
+    return None
+  with open(path, 'rb') as file:
+    if os.fstat(file.fileno()).st_size == 0:
+      return ''
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+      return data[:].decode('utf-8')
+
+# LRU cache of lyrics, (song id, lyrics path) -> text
+lyrics_cache = OrderedDict()
+lyrics_cache_size = 0
+lyrics_lock = threading.Lock()
+
+# Lyrics of a song, from the cache, the packed archive or the loose file
+def load_lyrics(song):
+  global lyrics_archive, lyrics_cache_size
+  if not song.songlyrics_path:
+    return None
+  key = (song.id, song.songlyrics_path)
+  with lyrics_lock:
+    text = lyrics_cache.get(key)
+    if text is not None:
+      lyrics_cache.move_to_end(key)
+      return text
+    if lyrics_archive is None and app.config['LYRICS_ARCHIVE']:
+      lyrics_archive = LyricsArchive(app.config['LYRICS_ARCHIVE'])
+  text = lyrics_archive.get(song.id) if lyrics_archive else None
+  if text is None:
+    text = read_lyrics_file(song.songlyrics_path)
+  if text is None:
+    return None
+  with lyrics_lock:
+    if key not in lyrics_cache:
+      lyrics_cache[key] = text
+      lyrics_cache_size += len(text)
+    # evict least recently read lyrics over the memory cap
+    while lyrics_cache_size > app.config['LYRICS_CACHE_SIZE'] and lyrics_cache:
+      lyrics_cache_size -= len(lyrics_cache.popitem(last=False)[1])
+  return text
+
+# Pack the loose lyrics files of all songs into one archive
+@app.cli.command('pack-lyrics')
+@click.argument('path')
+def pack_lyrics_command(path):
+  songs = db.session.execute(db.select(Song.id, Song.songlyrics_path).where(Song.songlyrics_path.isnot(None)).order_by(Song.id).execution_options(yield_per=1000))
+  lyrics = ((id, text) for id, text in ((id, read_lyrics_file(lyrics_path)) for id, lyrics_path in songs) if text is not None)
+  count = LyricsArchive.write(path, lyrics)
+  click.echo('Packed lyrics of ' + str(count) + ' songs into ' + path + '.')
+
+# Records of a CSV or JSONL catalog file, read lazily one line at a time
+def read_catalog(path):
+  with open(path, newline='', encoding='utf-8') as file:
+    if path.endswith('.csv'):
+      yield from csv.DictReader(file)
+    else:
+      for line in file:
+        if line.strip():
+          yield json.loads(line)
+
+def chunked(records, size):
+  chunk = []
+  for record in records:
+    chunk.append(record)
+    if len(chunk) == size:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
+
+# Insert one chunk of catalog records in a single transaction, returns the number of skipped records
+# genres: set of known genre names, albums: (album name, artist) -> album id, both updated in place
+def import_catalog_chunk(chunk, genres, albums):
+  skipped = 0
+  new_genres, album_rows, song_rows = [], [], []
+  changed = set()
+  for record in chunk:
+    kind = record.get('type')
+    if kind == 'genre' and record.get('name') and record['name'] not in genres:
+      genres.add(record['name'])
+      new_genres.append({'genrename': record['name']})
+    elif kind == 'album' and record.get('name') and record.get('genre') and record.get('artist'):
+      if (record['name'], record['artist']) in albums:
+        continue
+      # albums may name a genre that is not in the catalog yet
+      if record['genre'] not in genres:
+        genres.add(record['genre'])
+        new_genres.append({'genrename': record['genre']})
+      albums[(record['name'], record['artist'])] = None
+      album_rows.append({'albumname': record['name'], 'albumgenre': record['genre'], 'albumartist': record['artist'], 'albumnoofsongs': 0})
+    elif kind != 'song':
+      skipped += 1
+    else:
+      song_rows.append(record)
+  if new_genres:
+    db.session.execute(db.insert(Genre), new_genres)
+    bump_stat('genres', len(new_genres))
+  if album_rows:
+    last_album = db.session.scalar(db.select(db.func.max(Album.id))) or 0
+    ids = db.session.scalars(db.insert(Album).returning(Album.id, sort_by_parameter_order=True), album_rows).all()
+    for id, row in zip(ids, album_rows):
+      albums[(row['albumname'], row['albumartist'])] = id
+    changed.update(ids)
+    db.session.execute(db.text(album_search_insert + ' WHERE album.id > :id'), {'id': last_album})
+    bump_stat('albums', len(album_rows))
+  rows = []
+  for record in song_rows:
+    album_id = albums.get((record.get('album'), record.get('artist')))
+    try:
+      songduration = datetime.strptime(record.get('duration') or '', '%H:%M:%S').time()
+      songdateofcreation = datetime.strptime(record.get('date') or '', '%Y-%m-%d').date()
+    except ValueError:
+      album_id = None
+    if not album_id or not record.get('name'):
+      skipped += 1
+      continue
+    rows.append({'songname': record['name'], 'album_id': album_id, 'songduration': songduration, 'songdateofcreation': songdateofcreation,
+                 'songlyrics_path': record.get('lyrics_path') or None, 'songaudio_path': record.get('audio_path') or None})
+  if rows:
+    last_song = db.session.scalar(db.select(db.func.max(Song.id))) or 0
+    db.session.execute(db.insert(Song), rows)
+    ref_blobs([pair for row in rows for pair in (('audio', row['songaudio_path']), ('lyrics', row['songlyrics_path']))])
+    # keep the per album song counts in step with the inserted songs
+    counts = Counter(row['album_id'] for row in rows)
+    changed.update(counts)
+    db.session.execute(db.text('UPDATE album SET albumnoofsongs = albumnoofsongs + :count WHERE id = :album_id'),
+                       [{'album_id': album_id, 'count': count} for album_id, count in counts.items()])
+    db.session.execute(db.text(song_search_insert + ' WHERE song.id > :id'), {'id': last_song})
+    bump_stat('songs', len(rows))
+  bump_catalog(*changed, genres=bool(new_genres))
+  db.session.commit()
+  return skipped
+
+# Bulk import genres, albums and songs from a CSV or JSONL file
+# every record has a type (genre, album or song), genres a name, albums a name, genre and artist,
+# songs a name, album, artist, duration (HH:MM:SS), date (YYYY-MM-DD) and optional lyrics_path / audio_path
+@app.cli.command('import-catalog')
+@click.argument('path')
+@click.option('--batch-size', default=5000, help='Records inserted per transaction.')
+def import_catalog_command(path, batch_size):
+  genres = set(db.session.scalars(db.select(Genre.genrename)))
+  albums = {(name, artist): id for id, name, artist in db.session.execute(db.select(Album.id, Album.albumname, Album.albumartist))}
+  start = time.perf_counter()
+  total = skipped = 0
+  for chunk in chunked(read_catalog(path), batch_size):
+    skipped += import_catalog_chunk(chunk, genres, albums)
+    total += len(chunk)
+    click.echo(str(total) + ' records, ' + str(int(total / (time.perf_counter() - start))) + ' records/s')
+  click.echo('Imported ' + str(total - skipped) + ' records, skipped ' + str(skipped) + '.')
+
+# Add nullable columns declared on the models but missing from an existing database
+def add_missing_columns():
+  for table in db.metadata.sorted_tables:
+    existing = {row[1] for row in db.session.execute(db.text('PRAGMA table_info(' + table.name + ')'))}
+    for column in table.columns:
+      if column.name not in existing and column.nullable:
+        db.session.execute(db.text('ALTER TABLE ' + table.name + ' ADD COLUMN ' + column.name + ' ' + column.type.compile(db.engine.dialect)))
+  db.session.commit()
+
+# Move the old single table playlists (userid, songid) aside so the named playlist tables can be created
+def rename_old_playlists():
+  columns = {row[1] for row in db.session.execute(db.text('PRAGMA table_info(playlist)'))}
+  if not columns or 'id' in columns:
+    return False
+  db.session.execute(db.text('ALTER TABLE playlist RENAME TO playlist_old'))
+  db.session.commit()
+  return True
+
+# Give every user of the old layout one playlist holding their songs
+def copy_old_playlists():
+  db.session.execute(db.text("INSERT INTO playlist (userid, name) SELECT DISTINCT userid, 'My Playlist' FROM playlist_old"))
+  db.session.execute(db.text('''INSERT INTO playlist_song (playlistid, songid, position)
+    SELECT playlist.id, playlist_old.songid, playlist_old.rowid * :gap FROM playlist_old JOIN playlist ON playlist.userid = playlist_old.userid'''), {'gap': playlist_gap})
+  db.session.execute(db.text('DROP TABLE playlist_old'))
+  db.session.commit()
+
+# Versioned schema migrations for existing databases, (version, statements) in order
+# the applied version is kept in PRAGMA user_version, statements must also be safe on a fresh database
+migrations = [
+  (1, [
+    # genre names are the target of album.albumgenre, keep one row per name before making them unique
+    'DELETE FROM genre WHERE id NOT IN (SELECT MIN(id) FROM genre GROUP BY genrename)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS ix_genre_genrename ON genre (genrename)',
+    'CREATE INDEX IF NOT EXISTS ix_album_albumgenre ON album (albumgenre)',
+    'CREATE INDEX IF NOT EXISTS ix_song_album_id ON song (album_id)',
+    'CREATE INDEX IF NOT EXISTS ix_playlist_userid ON playlist (userid)',
+    'CREATE INDEX IF NOT EXISTS ix_playlist_song_songid ON playlist_song (songid)',
+    'CREATE INDEX IF NOT EXISTS ix_playlist_song_position ON playlist_song (playlistid, position)',
+  ]),
+  (2, [
+    'CREATE INDEX IF NOT EXISTS ix_similar_song_similarid ON similar_song (similarid)',
+  ]),
+  (3, [
+    # the duplicate genres removed by version 1 were still counted by the genres stat
+    "UPDATE stat SET value = (SELECT COUNT(*) FROM genre) WHERE name = 'genres'",
+  ]),
+]
+
+def schema_version():
+  return db.session.execute(db.text('PRAGMA user_version')).scalar()
+
+# Apply the migrations newer than the database, each in its own transaction
+def migrate():
+  for version, statements in migrations:
+    if version > schema_version():
+      for statement in statements:
+        db.session.execute(db.text(statement))
+      db.session.execute(db.text('PRAGMA user_version = ' + str(version)))
+      db.session.commit()
+
+@app.cli.command('migrate')
+def migrate_command():
+  migrate()
+  click.echo('Database at schema version ' + str(schema_version()) + '.')
+
+# Whether a scan of table is a keyset page: LIMITed and read in primary key order, so it stops after one page
+def keyset_scan(statement, plan, table):
+  order = re.search(r'ORDER BY\s+"?(\w+)"?\."?(\w+)"?', statement)
+  keys = [column.name for column in db.metadata.tables[table].primary_key] if table in db.metadata.tables else []
+  return ' LIMIT ' in statement and not any(step.startswith('USE TEMP B-TREE') for step in plan) and order is not None and order.group(1) == table and order.group(2) in keys
+
+# Drive every GET route as a user and as the admin, and the POST routes of flask bench, and fail on full scans of
+# large tables (keyset pages, such as the first page of a listing, are allowed). The POST routes write like the
+# benchmark does, so run it against a seeded or scratch database
+@app.cli.command('check-query-plans')
+@click.option('--large', default=1000, help='Row count from which a table counts as large.')
+def check_query_plans_command(large):
+  # the search index tables and their shadow tables are scanned by design
+  tables = [row[0] for row in db.session.execute(db.text("SELECT name FROM sqlite_master WHERE type = 'table'")) if not row[0].startswith(tuple(search_tables))]
+  large_tables = {table for table in tables if db.session.execute(db.text('SELECT COUNT(*) FROM ' + table)).scalar() >= large}
+  statements = []
+  def record(connection, cursor, statement, parameters, context, executemany):
+    if statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE', 'INSERT')) and not executemany:
+      statements.append((statement, parameters))
+  admin = User.query.filter_by(isadmin=True).first()
+  run = str(int(time.time()))
+  member = {'username': 'plans' + run, 'password': 'password', 'run': run}
+  member_id = bench_member(member['username'], member['password'])
+  member['playlist'] = default_playlist(member_id).id
+  db.session.commit()
+  ids = {table: db.session.scalar(db.text('SELECT MAX(id) FROM ' + table)) or 0 for table in ('genre', 'album', 'song', 'playlist')}
+  posts = bench_posts(random.Random(0), 0, ids, member)
+  # routes that change data on GET are not driven
+  skipped = {'creators_page', 'logout_page', 'static'}
+  urls = [rule.rule.replace('<int:', '<').replace('<id>', '1').replace('<song_id>', '1') for rule in app.url_map.iter_rules() if 'GET' in rule.methods and rule.endpoint not in skipped]
+  urls += ['/?parameter=album&search=a', '/?parameter=song&search=a']
+  # reading the whole catalog into the snapshot scans by design, it is loaded before the recording starts
+  catalog_snapshot()
+  event.listen(db.engine, 'before_cursor_execute', record)
+  try:
+    for user_id in (member_id, admin and admin.id):
+      if not user_id:
+        continue
+      client = bench_client(user_id)
+      for url in urls:
+        client.get(url)
+    for endpoint, role, url, data in posts:
+      if role == 'admin' and not admin:
+        continue
+      bench_client({'member': member_id, 'admin': admin and admin.id}.get(role)).post(url, data=data)
+  finally:
+    event.remove(db.engine, 'before_cursor_execute', record)
+  failures = 0
+  for statement, parameters in dict.fromkeys((statement, tuple(parameters)) for statement, parameters in statements):
+    plan = [row[3] for row in db.session.execute(db.text('SELECT 1')).connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)]
+    scans = [step for step in plan if step.startswith('SCAN ') and step.split()[1] in large_tables and 'USING' not in step]
+    if [step for step in scans if not keyset_scan(statement, plan, step.split()[1])]:
+      failures += 1
+      click.echo(' '.join(statement.split()) + '\n  ' + '; '.join(plan))
+  click.echo(str(len(statements)) + ' statements checked, ' + str(failures) + ' full scans of large tables.')
+  if failures:
+    raise SystemExit(1)
+
+# Revisit every conditional page as a user and as the admin with the tag of the first visit,
+# and fail unless the revisit is a 304 that ran no SQL and rendered no template
+@app.cli.command('check-conditional-pages')
+def check_conditional_pages_command():
+  work = []
+  def record_statement(*args):
+    work.append('sql')
+  def record_render(*args, **kwargs):
+    work.append('template')
+  failures = 0
+  for user in (User.query.filter_by(isadmin=False).first(), User.query.filter_by(isadmin=True).first()):
+    if not user:
+      continue
+    client = app.test_client()
+    with client.session_transaction() as client_session:
+      client_session['user_id'] = user.id
+    for endpoint in conditional_pages:
+      with app.test_request_context():
+        url = url_for(endpoint)
+      # a page showing pending flashed messages is not tagged, the second visit is
+      client.get(url)
+      first = client.get(url)
+      if 'ETag' not in first.headers:
+        continue
+      work.clear()
+      event.listen(db.engine, 'before_cursor_execute', record_statement)
+      template_rendered.connect(record_render, app)
+      try:
+        second = client.get(url, headers={'If-None-Match': first.headers['ETag']})
+      finally:
+        event.remove(db.engine, 'before_cursor_execute', record_statement)
+        template_rendered.disconnect(record_render, app)
+      ok = second.status_code == 304 and not work
+      failures += not ok
+      click.echo(('ok   ' if ok else 'FAIL ') + url + ' [' + user.username + '] ' + str(second.status_code) + ', '
+                 + str(work.count('sql')) + ' statements, ' + str(work.count('template')) + ' templates')
+  if failures:
+    raise SystemExit(1)
+
+# Seed a small catalog, count the statements of each catalog browse route, seed it ten times larger and count again,
+# and fail when a count grew or went over the limit. It seeds the configured database, so point it at a scratch one
+# (e.g. AMPLIFI_SQLALCHEMY_DATABASE_URI=sqlite:///check.sqlite3), a database that already has songs is refused
+@app.cli.command('check-catalog-queries')
+@click.option('--songs', default=500, help='Songs of the small catalog, the large one has ten times as many.')
+@click.option('--limit', default=6, help='Most statements a route may run.')
+@click.pass_context
+def check_catalog_queries_command(context, songs, limit):
+  init_database()
+  if Song.query.first():
+    raise click.ClickException('The database already has songs, run the check against a scratch database.')
+  seed_admin('admin123')
+  statements = []
+  def record(*args):
+    statements.append(args[2])
+  def count_statements():
+    admin = User.query.filter_by(isadmin=True).first()
+    # the member with the longest playlist, so its page is a full one
+    member = db.session.execute(db.select(Playlist.userid).join(PlaylistSong).group_by(Playlist.id).order_by(db.func.count().desc()).limit(1)).scalar()
+    album_id = db.session.scalar(db.select(db.func.max(Album.id)))
+    routes = [('member', '/'), ('member', '/?parameter=album&search=a'), ('member', '/?parameter=song&search=a'),
+              ('admin', '/album/<id>/open'), ('member', '/playlist')]
+    # the snapshot is read once per catalog version, not per request
+    catalog_snapshot()
+    counts = {}
+    for role, url in routes:
+      client = app.test_client()
+      with client.session_transaction() as client_session:
+        client_session['user_id'] = admin.id if role == 'admin' else member
+      # the first request of a worker also checks the schema, count a second one that renders the page again
+      client.get(url.replace('<id>', str(album_id))).get_data()
+      fragment_cache.clear()
+      statements.clear()
+      event.listen(db.engine, 'before_cursor_execute', record)
+      try:
+        response = client.get(url.replace('<id>', str(album_id)))
+        response.get_data()
+      finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+      counts[url] = (response.status_code, len(statements))
+    return counts
+  context.invoke(seed_catalog_command, users=songs // 10, genres=5, albums=songs // 20, songs=songs, playlist_rows=songs * 2)
+  small = count_statements()
+  context.invoke(seed_catalog_command, users=songs, genres=45, albums=songs // 2, songs=songs * 9, playlist_rows=songs * 18, seed=1)
+  large = count_statements()
+  failures = 0
+  for url, (status, count) in small.items():
+    ok = status == 200 and large[url][0] == 200 and large[url][1] == count and count <= limit
+    failures += not ok
+    click.echo(('ok   ' if ok else 'FAIL ') + url + ' ' + str(status) + '/' + str(large[url][0]) + ', ' + str(count) + ' statements with ' + str(songs) + ' songs, ' + str(large[url][1]) + ' with ' + str(songs * 10))
+  if failures:
+    raise SystemExit(1)
+
+# Nearest rank percentile of sorted values
+def percentile(values, p):
+  return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))] if values else None
+
+# Request metrics per endpoint: totals plus a rolling window of request durations
+metrics_buckets = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500]
+endpoint_metrics = {}
+slow_queries = deque(maxlen=100)
+metrics_lock = threading.Lock()
+
+def before_query(connection, cursor, statement, parameters, context, executemany):
+  if has_request_context() and 'metrics_start' in g:
+    g.query_start = time.perf_counter()
+
+def after_query(connection, cursor, statement, parameters, context, executemany):
+  if not has_request_context() or 'query_start' not in g:
+    return
+  elapsed = (time.perf_counter() - g.query_start) * 1000
+  g.query_count += 1
+  g.query_ms += elapsed
+  g.slowest_queries = sorted(g.slowest_queries + [(elapsed, statement)], reverse=True)[:3]
+  if elapsed >= app.config['SLOW_QUERY_MS']:
+    slow_queries.append({'endpoint': request.endpoint, 'ms': round(elapsed, 3), 'statement': ' '.join(statement.split()), 'at': datetime.now().isoformat(timespec='seconds')})
+    app.logger.warning('Slow query (%.1f ms) on %s: %s', elapsed, request.endpoint, statement)
+
+def before_render(sender, template, context, **extra):
+  if 'metrics_start' in g:
+    g.render_start = time.perf_counter()
+
+def after_render(sender, template, context, **extra):
+  if 'render_start' in g:
+    g.render_ms += (time.perf_counter() - g.render_start) * 1000
+
+def start_request_metrics():
+  g.metrics_start = time.perf_counter()
+  g.query_count = 0
+  g.query_ms = 0.0
+  g.render_ms = 0.0
+  g.slowest_queries = []
+
+def record_request_metrics(response):
+  if 'metrics_start' not in g or not request.endpoint:
+    return response
+  elapsed = (time.perf_counter() - g.metrics_start) * 1000
+  with metrics_lock:
+    metrics = endpoint_metrics.get(request.endpoint)
+    if metrics is None:
+      metrics = endpoint_metrics[request.endpoint] = {'requests': 0, 'queries': 0, 'db_ms': 0.0, 'render_ms': 0.0, 'slowest': [], 'window': deque(maxlen=app.config['METRICS_WINDOW'])}
+    metrics['requests'] += 1
+    metrics['queries'] += g.query_count
+    metrics['db_ms'] += g.query_ms
+    metrics['render_ms'] += g.render_ms
+    metrics['slowest'] = sorted(metrics['slowest'] + g.slowest_queries, reverse=True)[:3]
+    metrics['window'].append(elapsed)
+  return response
+
+# Summary of the endpoint metrics, as shown on the performance panel and the metrics endpoint
+def metrics_report():
+  endpoints = {}
+  with metrics_lock:
+    for endpoint, metrics in sorted(endpoint_metrics.items()):
+      window = sorted(metrics['window'])
+      histogram = Counter(next((bucket for bucket in metrics_buckets if ms <= bucket), 'inf') for ms in window)
+      endpoints[endpoint] = {
+        'requests': metrics['requests'],
+        'queries_mean': round(metrics['queries'] / metrics['requests'], 2),
+        'db_ms_mean': round(metrics['db_ms'] / metrics['requests'], 3),
+        'render_ms_mean': round(metrics['render_ms'] / metrics['requests'], 3),
+        'p50_ms': round(percentile(window, 50), 3),
+        'p95_ms': round(percentile(window, 95), 3),
+        'p99_ms': round(percentile(window, 99), 3),
+        'histogram_ms': {str(bucket): histogram[bucket] for bucket in metrics_buckets + ['inf']},
+        'slowest': [{'ms': round(ms, 3), 'statement': ' '.join(statement.split())} for ms, statement in metrics['slowest']],
+      }
+  return {'enabled': app.config['METRICS_ENABLED'], 'slow_query_ms': app.config['SLOW_QUERY_MS'], 'endpoints': endpoints, 'slow_queries': list(slow_queries)}
+
+# Hook the metrics into the engine, the templates and the request cycle
+def install_metrics():
+  event.listen(db.engine, 'before_cursor_execute', before_query)
+  event.listen(db.engine, 'after_cursor_execute', after_query)
+  before_render_template.connect(before_render, app)
+  template_rendered.connect(after_render, app)
+  app.before_request(start_request_metrics)
+  app.after_request(record_request_metrics)
+
+# Build time asset pipeline. Static files are copied to the asset folder under content hashed names,
+# images optimized, text files also written gzipped, and the inline style block of every page template
+# extracted to a stylesheet named after its content, so pages with the same styles share one cached file.
+# Without a build every asset is served from the static folder and the style blocks stay inline
+asset_text_types = ('.css', '.js', '.svg', '.txt')
+asset_manifest = None
+
+def load_asset_manifest():
+  global asset_manifest
+  if asset_manifest is None:
+    try:
+      with open(os.path.join(app.config['ASSET_FOLDER'], 'manifest.json')) as f:
+        asset_manifest = json.load(f)
+    except FileNotFoundError:
+      asset_manifest = {'files': {}, 'styles': {}}
+  return asset_manifest
+
+# URL of a static file, its fingerprinted copy once the assets are built
+@app.template_global()
+def asset_url(filename):
+  built = load_asset_manifest()['files'].get(filename)
+  if built:
+    return url_for('asset_file', filename=built)
+  return url_for('static', filename=filename)
+
+# Stylesheet holding the style block of the page being rendered, None keeps the block inline
+@app.template_global()
+@pass_context
+def page_stylesheet(context):
+  built = load_asset_manifest()['styles'].get(context.name)
+  return url_for('asset_file', filename=built) if built else None
+
+# Write one fingerprinted asset (and its gzipped copy for text types), returns its name in the asset folder
+def write_asset(filename, data):
+  root, extension = os.path.splitext(filename)
+  built = root + '.' + hashlib.sha256(data).hexdigest()[:12] + extension
+  path = os.path.join(app.config['ASSET_FOLDER'], built)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(path, 'wb') as f:
+    f.write(data)
+  compressed = zlib.compress(data, 9, 31) if extension in asset_text_types else data
+  if len(compressed) < len(data):
+    with open(path + '.gz', 'wb') as f:
+      f.write(compressed)
+  return built
+
+# Smaller re-encoding of a PNG or JPEG image, the original bytes when it isn't smaller
+def optimize_image(path, data):
+  if not pillow_available or os.path.splitext(path)[1].lower() not in ('.png', '.jpg', '.jpeg'):
+    return data
+  from PIL import Image
+  output = io.BytesIO()
+  with Image.open(path) as image:
+    if image.format == 'PNG':
+      image.save(output, 'PNG', optimize=True)
+    else:
+      image.save(output, 'JPEG', quality=85, optimize=True, progressive=True)
+  return output.getvalue() if output.tell() < len(data) else data
+
+@app.cli.command('build-assets')
+def build_assets_command():
+  folder = app.config['ASSET_FOLDER']
+  shutil.rmtree(folder, ignore_errors=True)
+  manifest = {'files': {}, 'styles': {}}
+  before = after = 0
+  for root, dirs, files in os.walk(app.static_folder):
+    for name in files:
+      path = os.path.join(root, name)
+      filename = os.path.relpath(path, app.static_folder).replace(os.sep, '/')
+      with open(path, 'rb') as f:
+        data = f.read()
+      optimized = optimize_image(path, data)
+      before += len(data)
+      after += len(optimized)
+      manifest['files'][filename] = write_asset(filename, optimized)
+  # a page's style block is extracted only when it is one plain <style> element
+  style_block = re.compile(r'{%\s*block style\s*%}\s*<style>(.*?)</style>\s*{%\s*endblock\s*%}', re.S)
+  for name in app.jinja_env.list_templates():
+    source = app.jinja_loader.get_source(app.jinja_env, name)[0]
+    match = style_block.search(source)
+    if match and name != 'layout.html' and '{{' not in match.group(1) and '{%' not in match.group(1):
+      css = '\n'.join(line.strip() for line in match.group(1).strip().splitlines()) + '\n'
+      manifest['styles'][name] = write_asset('css/pages/page.css', css.encode())
+  with open(os.path.join(folder, 'manifest.json'), 'w') as f:
+    json.dump(manifest, f, indent=2)
+  click.echo('Built ' + str(len(manifest['files'])) + ' files (' + str(before) + ' -> ' + str(after) + ' bytes) and '
+             + str(len(set(manifest['styles'].values()))) + ' stylesheets for ' + str(len(manifest['styles'])) + ' pages.')
+
+# Define the route for built assets, their names change with their content so they are cached for a year
+@app.route('/assets/<path:filename>')
+def asset_file(filename):
+  mimetype = mimetypes.guess_type(filename)[0]
+  gzipped = 'gzip' in request.headers.get('Accept-Encoding', '') and os.path.isfile(safe_join(app.config['ASSET_FOLDER'], filename + '.gz') or '')
+  response = send_from_directory(app.config['ASSET_FOLDER'], filename + '.gz' if gzipped else filename, mimetype=mimetype, max_age=365 * 24 * 3600)
+  if gzipped:
+    response.headers['Content-Encoding'] = 'gzip'
+  response.vary.add('Accept-Encoding')
+  response.cache_control.immutable = True
+  response.cache_control.public = True
+  return response
+
+# WSGI middleware gzipping HTML and JSON responses for clients that accept it, chunk by chunk,
+# so streamed bodies keep streaming. Responses already encoded or marked no-transform are left alone
+class GzipMiddleware:
+  types = ('text/html', 'application/json')
+
+  def __init__(self, wsgi_app):
+    self.wsgi_app = wsgi_app
+
+  def __call__(self, environ, start_response):
+    if 'gzip' not in environ.get('HTTP_ACCEPT_ENCODING', ''):
+      return self.wsgi_app(environ, start_response)
+    state = {}
+    def gzip_start_response(status, headers, exc_info=None):
+      headers = Headers(headers)
+      length = headers.get('Content-Length', type=int)
+      if (status.startswith('200') and headers.get('Content-Type', '').split(';')[0] in self.types
+          and 'Content-Encoding' not in headers and 'no-transform' not in headers.get('Cache-Control', '')
+          and (length is None or length >= app.config['GZIP_MIN_SIZE'])):
+        state['streamed'] = length is None
+        headers.remove('Content-Length')
+        headers['Content-Encoding'] = 'gzip'
+        headers['Vary'] = headers['Vary'] + ', Accept-Encoding' if 'Vary' in headers else 'Accept-Encoding'
+        # the compressed body is another representation of the same content
+        if headers.get('ETag', '').startswith('"'):
+          headers['ETag'] = 'W/' + headers['ETag']
+      return start_response(status, headers.to_wsgi_list(), exc_info)
+    body = self.wsgi_app(environ, gzip_start_response)
+    if not state:
+      return body
+    # a HEAD response has the headers of the gzipped GET, but no body, not even an empty gzip stream
+    if environ['REQUEST_METHOD'] == 'HEAD':
+      if hasattr(body, 'close'):
+        body.close()
+      return []
+    return self.compress(body, state['streamed'])
+
+  def compress(self, body, streamed):
+    compressor = zlib.compressobj(app.config['GZIP_LEVEL'], zlib.DEFLATED, 31)
+    try:
+      for chunk in body:
+        data = compressor.compress(chunk)
+        # a streamed chunk goes out as soon as it is produced
+        if streamed:
+          data += compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+          yield data
+      yield compressor.flush()
+    finally:
+      if hasattr(body, 'close'):
+        body.close()
+
+# Fingerprint of the declared tables, columns and indexes and of the migrations, stored once the schema matches it
+def schema_fingerprint():
+  tables = [(table.name, sorted(column.name for column in table.columns), sorted(index.name for index in table.indexes)) for table in db.metadata.sorted_tables]
+  return zlib.crc32(repr((tables, migrations[-1][0])).encode())
+
+# Create or upgrade the schema, the search index and the stat counters of the database
+def init_database():
+  old_playlists = rename_old_playlists()
   db.create_all()
-  # Create an admin user if it doesn't exist
-  admin = User.query.filter_by(username='admin').first()
-  if not admin:
-    admin = User(username='admin', password='admin123', name='Admin', isadmin=True, iscreator=True)
-    db.session.add(admin)
+  if old_playlists:
+    copy_old_playlists()
+  add_missing_columns()
+  migrate()
+  if create_search_index():
+    rebuild_search_index()
+  seed_stats()
+  db.session.merge(Stat(name='schema_fingerprint', value=schema_fingerprint()))
+  db.session.commit()
+
+# Create the admin user if it doesn't exist
+def seed_admin(password):
+  if not User.query.filter_by(username='admin').first():
+    db.session.add(User(username='admin', password=password, name='Admin', isadmin=True, iscreator=True))
+    bump_stat('users')
+    bump_stat('creators')
     db.session.commit()
 
+@app.cli.command('init-db')
+def init_db_command():
+  init_database()
+  click.echo('Database at schema version ' + str(schema_version()) + '.')
+
+# Everything a new deployment needs before its workers start
+@app.cli.command('bootstrap')
+@click.option('--admin-password', default='admin123', help='Password of the admin user when it is created.')
+@click.pass_context
+def bootstrap_command(context, admin_password):
+  init_database()
+  seed_admin(admin_password)
+  context.invoke(compile_templates_command)
+  click.echo('Database at schema version ' + str(schema_version()) + ', admin user present.')
+
+# Checked once by the first request of each worker, one query when the schema is current
+database_ready = False
+database_lock = threading.Lock()
+
+def ensure_database():
+  global database_ready
+  if database_ready:
+    return
+  with database_lock:
+    if database_ready:
+      return
+    try:
+      stored = db.session.get(Stat, 'schema_fingerprint')
+    except OperationalError:
+      # no stat table yet, a new database
+      db.session.rollback()
+      stored = None
+    if not stored or stored.value != schema_fingerprint():
+      init_database()
+      seed_admin('admin123')
+    database_ready = True
+
+# Compile every template into the bytecode cache, so new workers load them instead of compiling
+@app.cli.command('compile-templates')
+def compile_templates_command():
+  if not app.config['TEMPLATE_CACHE_FOLDER']:
+    raise click.ClickException('TEMPLATE_CACHE_FOLDER is not set.')
+  start = time.perf_counter()
+  names = app.jinja_env.list_templates()
+  for name in names:
+    app.jinja_env.get_template(name)
+  click.echo('Compiled ' + str(len(names)) + ' templates in ' + str(round((time.perf_counter() - start) * 1000)) + ' ms.')
+
+# Start fresh worker processes one after another and time their import and first response
+startup_script = '''
+import json, sys, time
+start = time.perf_counter()
+app = __import__(sys.argv[1]).create_app()
+imported = time.perf_counter()
+response = app.test_client().get(sys.argv[2])
+done = time.perf_counter()
+print(json.dumps({'import_ms': (imported - start) * 1000, 'first_response_ms': (done - imported) * 1000, 'status': response.status_code}))
+'''
+
+@app.cli.command('bench-startup')
+@click.option('--workers', default=5, help='Worker processes to start.')
+@click.option('--url', default='/login', help='URL of the first request.')
+def bench_startup_command(workers, url):
+  runs = []
+  for _ in range(workers):
+    output = subprocess.run([sys.executable, '-c', startup_script, app.import_name, url], capture_output=True, text=True, cwd=app.root_path, check=True).stdout
+    runs.append(json.loads(output.splitlines()[-1]))
+  report = {'workers': workers, 'url': url, 'status': sorted({run['status'] for run in runs})}
+  for key in ('import_ms', 'first_response_ms'):
+    values = sorted(run[key] for run in runs)
+    report[key] = {'p50': round(percentile(values, 50), 1), 'max': round(values[-1], 1)}
+  report['total_ms'] = {'p50': round(percentile(sorted(run['import_ms'] + run['first_response_ms'] for run in runs), 50), 1)}
+  click.echo(json.dumps(report, indent=2))
+
 # Additional models thoughts (commented out for now)
 '''
 class Artist_Album(db.Model):
@@ -119,6 +1309,807 @@ def home_page():
     return render_template("welcome.html")
 '''
 
+# Read optimized copy of the catalog the browse and search pages are served from.
+# Columns are parallel arrays / tuples sorted by id, ids are found by bisection, and songs are grouped by album
+# so the songs of the album at index i are the slice song_starts[i]:song_starts[i + 1] of the song columns.
+# song_keys / song_key_albums map song ids to album ids. Durations are kept in seconds, dates as ordinals.
+# suggest_keys / suggest_refs are the typeahead index, see suggest_entries.
+# A snapshot is never modified: a change builds a new one sharing the untouched slices and swaps it in with
+# one assignment, so readers never lock
+class CatalogSnapshot:
+  __slots__ = ('seq', 'version', 'genre_ids', 'genre_names', 'album_ids', 'album_names', 'album_genres', 'album_artists', 'song_counts',
+               'song_starts', 'song_ids', 'song_names', 'song_audio', 'song_seconds', 'song_days', 'song_keys', 'song_key_albums',
+               'suggest_keys', 'suggest_refs')
+  album_columns = ('album_ids', 'album_names', 'album_genres', 'album_artists', 'song_counts')
+  song_columns = ('song_ids', 'song_names', 'song_audio', 'song_seconds', 'song_days')
+
+  def __init__(self, **columns):
+    for name, value in columns.items():
+      setattr(self, name, value)
+    if 'song_starts' not in columns:
+      self.song_starts = array('q', accumulate(self.song_counts, initial=0))
+    if 'suggest_keys' not in columns:
+      entries = sorted(suggest_entries(self, 0, len(self.album_ids)))
+      self.suggest_keys = tuple(key for key, ref in entries)
+      self.suggest_refs = array('q', [ref for key, ref in entries])
+
+  def replace(self, **columns):
+    return CatalogSnapshot(**dict({name: getattr(self, name) for name in self.__slots__}, **columns))
+
+  def album_index(self, id):
+    i = bisect.bisect_left(self.album_ids, id)
+    return i if i < len(self.album_ids) and self.album_ids[i] == id else None
+
+  def album(self, id):
+    i = self.album_index(id)
+    return None if i is None else AlbumRecord(self, i)
+
+  # the album of a song, by song id
+  def song_album(self, id):
+    i = bisect.bisect_left(self.song_keys, id)
+    if i < len(self.song_keys) and self.song_keys[i] == id:
+      return self.album(self.song_key_albums[i])
+
+  def song(self, id):
+    album = self.song_album(id)
+    if album is None:
+      return None
+    start, end = self.song_starts[album.index], self.song_starts[album.index + 1]
+    i = bisect.bisect_left(self.song_ids, id, start, end)
+    return SongRecord(self, i) if i < end and self.song_ids[i] == id else None
+
+  # Typeahead matches of a prefix in name order, each artist once: (kind, id, name)
+  def suggest(self, prefix, count):
+    prefix = prefix.casefold()
+    keys, refs = self.suggest_keys, self.suggest_refs
+    results, artists = [], set()
+    i = bisect.bisect_left(keys, prefix)
+    while i < len(keys) and len(results) < count and keys[i].startswith(prefix):
+      kind, id = suggest_kinds[refs[i] & 3], refs[i] >> 2
+      if kind == 'song':
+        results.append((kind, id, self.song(id).songname))
+      elif kind == 'album':
+        results.append((kind, id, self.album(id).albumname))
+      elif keys[i] not in artists:
+        artists.add(keys[i])
+        results.append((kind, id, self.album(id).albumartist))
+      i += 1
+    return results
+
+# Typeahead entries of the albums at index start to end and their songs, (casefolded name, id * 4 + kind) where kind
+# indexes suggest_kinds. Entries sort by name, so the names starting with a prefix are one run found by bisection.
+# An artist is entered once per album under the album id
+suggest_kinds = ('song', 'album', 'artist')
+
+def suggest_entries(catalog, start, end):
+  for i in range(start, end):
+    album_id = catalog.album_ids[i]
+    yield catalog.album_names[i].casefold(), album_id * 4 + 1
+    yield catalog.album_artists[i].casefold(), album_id * 4 + 2
+    for j in range(catalog.song_starts[i], catalog.song_starts[i + 1]):
+      yield catalog.song_names[j].casefold(), catalog.song_ids[j] * 4
+
+# Views of one row of a snapshot under the model's attribute names, so the templates take either
+class CatalogRecord:
+  __slots__ = ('catalog', 'index')
+
+  def __init__(self, catalog, index):
+    self.catalog = catalog
+    self.index = index
+
+def catalog_column(name):
+  return property(lambda self: getattr(self.catalog, name)[self.index])
+
+class GenreRecord(CatalogRecord):
+  __slots__ = ()
+  id = catalog_column('genre_ids')
+  genrename = catalog_column('genre_names')
+
+class AlbumRecord(CatalogRecord):
+  __slots__ = ()
+  id = catalog_column('album_ids')
+  albumname = catalog_column('album_names')
+  albumgenre = catalog_column('album_genres')
+  albumartist = catalog_column('album_artists')
+
+  @property
+  def songs(self):
+    starts = self.catalog.song_starts
+    return [SongRecord(self.catalog, i) for i in range(starts[self.index], starts[self.index + 1])]
+
+class SongRecord(CatalogRecord):
+  __slots__ = ()
+  id = catalog_column('song_ids')
+  songname = catalog_column('song_names')
+  songaudio_path = catalog_column('song_audio')
+
+  @property
+  def songduration(self):
+    return (datetime.min + timedelta(seconds=self.catalog.song_seconds[self.index])).time()
+
+  @property
+  def songdateofcreation(self):
+    return date.fromordinal(self.catalog.song_days[self.index])
+
+# Catalog reads, songs without their album are left out. Durations come back in seconds, dates as days since 0001-01-01 (day 1)
+catalog_albums_query = 'SELECT album.id, album.albumname, album.albumgenre, album.albumartist FROM album'
+catalog_songs_query = '''SELECT song.album_id, song.id, song.songname, song.songaudio_path,
+  CAST(round((julianday(song.songduration) - julianday('00:00:00')) * 86400) AS INTEGER), CAST(julianday(song.songdateofcreation) - 1721424.5 AS INTEGER)
+  FROM song JOIN album ON album.id = song.album_id'''
+
+def catalog_query(sql, order, album_ids):
+  if album_ids is None:
+    return db.text(sql + order), {}
+  return db.text(sql + ' WHERE album.id IN :ids' + order).bindparams(db.bindparam('ids', expanding=True)), {'ids': sorted(album_ids)}
+
+def read_catalog_genres(connection):
+  rows = connection.execute(db.text('SELECT id, genrename FROM genre ORDER BY id')).all()
+  return {'genre_ids': array('q', [row[0] for row in rows]), 'genre_names': tuple(row[1] for row in rows)}
+
+# Album and song columns of the given albums, or of the whole catalog
+def read_catalog_albums(connection, album_ids=None):
+  ids, names, genres, artists = array('q'), [], [], []
+  # repeated genre and artist names share one string
+  shared = {}
+  for id, name, genre, artist in connection.execute(*catalog_query(catalog_albums_query, ' ORDER BY album.id', album_ids)):
+    ids.append(id)
+    names.append(name)
+    genres.append(shared.setdefault(genre, genre))
+    artists.append(shared.setdefault(artist, artist))
+  known = set(ids)
+  counts = Counter()
+  song_ids, song_names, song_audio, song_seconds, song_days = array('q'), [], [], array('i'), array('i')
+  for album_id, id, name, audio, seconds, days in connection.execute(*catalog_query(catalog_songs_query, ' ORDER BY song.album_id, song.id', album_ids)):
+    # an album added between the two reads comes with the next change
+    if album_id not in known:
+      continue
+    counts[album_id] += 1
+    song_ids.append(id)
+    song_names.append(name)
+    song_audio.append(audio)
+    song_seconds.append(seconds or 0)
+    song_days.append(days or 1)
+  return {'album_ids': ids, 'album_names': tuple(names), 'album_genres': tuple(genres), 'album_artists': tuple(artists),
+          'song_counts': array('i', [counts[id] for id in ids]), 'song_ids': song_ids, 'song_names': tuple(song_names),
+          'song_audio': tuple(song_audio), 'song_seconds': song_seconds, 'song_days': song_days}
+
+# The whole catalog, the change log position is read first so changes made during the reads are applied again later
+def build_catalog(connection, version):
+  seq = connection.execute(db.select(db.func.coalesce(db.func.max(CatalogChange.seq), 0))).scalar()
+  columns = read_catalog_albums(connection)
+  keys, key_albums = array('q'), array('q')
+  for id, album_id in connection.execute(db.text('SELECT song.id, song.album_id FROM song JOIN album ON album.id = song.album_id ORDER BY song.id')):
+    keys.append(id)
+    key_albums.append(album_id)
+  return CatalogSnapshot(seq=seq, version=version, song_keys=keys, song_key_albums=key_albums, **read_catalog_genres(connection), **columns)
+
+def join_columns(parts):
+  if isinstance(parts[0], array):
+    joined = array(parts[0].typecode)
+    for part in parts:
+      joined.extend(part)
+    return joined
+  return tuple(chain.from_iterable(parts))
+
+def join_value(column, value):
+  return array(column.typecode, [value]) if isinstance(column, array) else (value,)
+
+# A pair of parallel columns sorted by (key, value), without the removed and with the added (key, value) pairs.
+# Put together from slices of the old columns rather than shifting them once per pair
+def splice_sorted(keys, values, removed, added):
+  def position(pair):
+    return bisect.bisect_left(range(len(keys)), pair, key=lambda i: (keys[i], values[i]))
+  # a pair both removed and added (or added again over a stale snapshot) is dropped once
+  drops = set()
+  for pair in chain(removed, added):
+    k = position(pair)
+    if k < len(keys) and (keys[k], values[k]) == pair:
+      drops.add(k)
+  edits = sorted([(k, 1, None) for k in drops] + [(position(pair), 0, pair) for pair in set(added)])
+  key_parts, value_parts = [], []
+  start = 0
+  for k, drop, pair in edits:
+    key_parts.append(keys[start:k])
+    value_parts.append(values[start:k])
+    start = k + 1 if drop else k
+    if not drop:
+      key_parts.append(join_value(keys, pair[0]))
+      value_parts.append(join_value(values, pair[1]))
+  key_parts.append(keys[start:])
+  value_parts.append(values[start:])
+  return join_columns(key_parts), join_columns(value_parts)
+
+# A new snapshot with the given albums and their songs read again, albums gone from the database are dropped
+def patch_catalog(old, connection, album_ids, genres, seq, version):
+  new = CatalogSnapshot(**read_catalog_albums(connection, album_ids))
+  columns = CatalogSnapshot.album_columns + CatalogSnapshot.song_columns
+  parts = {name: [] for name in columns}
+  def copy(source, start, end):
+    for name in CatalogSnapshot.album_columns:
+      parts[name].append(getattr(source, name)[start:end])
+    for name in CatalogSnapshot.song_columns:
+      parts[name].append(getattr(source, name)[source.song_starts[start]:source.song_starts[end]])
+  removed, added, removed_entries = [], [], []
+  cursor = 0
+  for album_id in sorted(album_ids):
+    i = bisect.bisect_left(old.album_ids, album_id, cursor)
+    copy(old, cursor, i)
+    cursor = i
+    if i < len(old.album_ids) and old.album_ids[i] == album_id:
+      cursor = i + 1
+      removed.extend((song_id, album_id) for song_id in old.song_ids[old.song_starts[i]:old.song_starts[i + 1]])
+      removed_entries.extend(suggest_entries(old, i, i + 1))
+    j = new.album_index(album_id)
+    if j is not None:
+      copy(new, j, j + 1)
+      added.extend((song_id, album_id) for song_id in new.song_ids[new.song_starts[j]:new.song_starts[j + 1]])
+  copy(old, cursor, len(old.album_ids))
+  keys, key_albums = splice_sorted(old.song_keys, old.song_key_albums, removed, added)
+  suggest_keys, suggest_refs = splice_sorted(old.suggest_keys, old.suggest_refs, removed_entries, list(zip(new.suggest_keys, new.suggest_refs)))
+  return CatalogSnapshot(seq=seq, version=version, song_keys=keys, song_key_albums=key_albums, suggest_keys=suggest_keys, suggest_refs=suggest_refs,
+                         **(read_catalog_genres(connection) if genres else {'genre_ids': old.genre_ids, 'genre_names': old.genre_names}),
+                         **{name: join_columns(parts[name]) for name in columns})
+
+# Snapshot for the given catalog page version, patched from the change log or read whole.
+# Reads go through a connection of their own, a request's session may still be on an older read transaction
+def load_catalog(old, version):
+  with db.engine.connect() as connection:
+    if old is not None:
+      changes = connection.execute(db.select(CatalogChange.seq, CatalogChange.kind, CatalogChange.albumid).where(CatalogChange.seq > old.seq).order_by(CatalogChange.seq)).all()
+      if not changes:
+        return old.replace(version=version)
+      album_ids = {change.albumid for change in changes if change.kind == 'album'}
+      kinds = {change.kind for change in changes}
+      # a gap means the log was trimmed past this snapshot
+      if changes[0].seq == old.seq + 1 and 'all' not in kinds and len(album_ids) <= app.config['CATALOG_PATCH_LIMIT']:
+        return patch_catalog(old, connection, album_ids, 'genres' in kinds, changes[-1].seq, version)
+    return build_catalog(connection, version)
+
+current_catalog = None
+catalog_lock = threading.Lock()
+
+# The current catalog snapshot. Only the request that finds it behind the shared 'catalog' page version waits for
+# the catch up, one at a time, everything else reads the snapshot it finds
+def catalog_snapshot():
+  global current_catalog
+  versions = get_page_versions()
+  version = (versions.epoch, versions.get('catalog'))
+  catalog = current_catalog
+  if catalog is not None and catalog.version == version:
+    return catalog
+  with catalog_lock:
+    if current_catalog is None or current_catalog.version != version:
+      current_catalog = load_catalog(current_catalog, version)
+    return current_catalog
+
+# keyset_page over the sorted ids of a snapshot, record(i) gives the row at index i
+def catalog_page(ids, record):
+  size = app.config['PAGE_SIZE']
+  after = request.args.get('after', type=int)
+  before = request.args.get('before', type=int)
+  if before is not None:
+    end = bisect.bisect_left(ids, before)
+    start = max(0, end - size)
+    has_prev, has_next = start > 0, True
+  else:
+    start = bisect.bisect_right(ids, after) if after is not None else 0
+    end = min(len(ids), start + size)
+    has_prev, has_next = after is not None, end < len(ids)
+  items = [record(i) for i in range(start, end)]
+  return {
+    'items': items,
+    'args': {name: value for name, value in request.args.items() if name not in ('after', 'before')},
+    'prev': ids[start] if items and has_prev else None,
+    'next': ids[end - 1] if items and has_next else None,
+  }
+
+# Catalog browse reads, served from the snapshot
+def catalog_albums():
+  catalog = catalog_snapshot()
+  return catalog_page(catalog.album_ids, lambda i: AlbumRecord(catalog, i))
+
+def catalog_genres():
+  catalog = catalog_snapshot()
+  return catalog_page(catalog.genre_ids, lambda i: GenreRecord(catalog, i))
+
+def catalog_album(id):
+  return catalog_snapshot().album(id)
+
+def catalog_search_albums(search):
+  # matching albums, best match first
+  catalog = catalog_snapshot()
+  albums = [catalog.album(id) for id in search_ids('album_search', search)]
+  return [album for album in albums if album]
+
+def catalog_song_albums(search):
+  # albums of the matching songs, best match first
+  catalog = catalog_snapshot()
+  albums = [catalog.song_album(id) for id in search_ids('song_search', search)]
+  return [album for album in albums if album]
+
+# Resident set size of this process in bytes
+def current_rss():
+  try:
+    with open('/proc/self/statm') as file:
+      return int(file.read().split()[1]) * resource.getpagesize()
+  except OSError:
+    # ru_maxrss is in kilobytes on Linux, the peak rather than the current size
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# Build a catalog snapshot of the current database and report its build time and memory,
+# then time patching it for a handful of changed albums and typeahead lookups of short prefixes
+@app.cli.command('catalog-memory')
+@click.option('--patch-albums', default=10, help='Albums read again by the patch timing.')
+@click.option('--suggestions', default=1000, help='Typeahead lookups timed.')
+def catalog_memory_command(patch_albums, suggestions):
+  rss = current_rss()
+  start = time.perf_counter()
+  with db.engine.connect() as connection:
+    catalog = build_catalog(connection, None)
+  built = time.perf_counter() - start
+  size = current_rss() - rss
+  songs = len(catalog.song_ids)
+  click.echo(str(songs) + ' songs, ' + str(len(catalog.album_ids)) + ' albums, ' + str(len(catalog.genre_ids)) + ' genres read in ' + str(round(built, 2)) + ' s')
+  # RSS also counts the SQLite page cache and memory mapped database pages the reads touched
+  values = {id(value): value for value in chain(catalog.genre_names, catalog.album_names, catalog.album_genres, catalog.album_artists, catalog.song_names, catalog.song_audio, catalog.suggest_keys) if value is not None}
+  owned = sum(sys.getsizeof(getattr(catalog, name)) for name in CatalogSnapshot.__slots__ if name not in ('seq', 'version')) + sum(map(sys.getsizeof, values.values()))
+  click.echo('RSS grew by ' + str(round(size / 2 ** 20, 1)) + ' MB, ' + str(size // max(songs, 1)) + ' bytes per song')
+  click.echo('Snapshot objects take ' + str(round(owned / 2 ** 20, 1)) + ' MB, ' + str(owned // max(songs, 1)) + ' bytes per song')
+  album_ids = set(random.Random(0).sample(list(catalog.album_ids), min(patch_albums, len(catalog.album_ids))))
+  start = time.perf_counter()
+  with db.engine.connect() as connection:
+    patch_catalog(catalog, connection, album_ids, False, catalog.seq, None)
+  click.echo('Patched ' + str(len(album_ids)) + ' albums in ' + str(round((time.perf_counter() - start) * 1000, 1)) + ' ms')
+  # prefixes of one to four characters of catalog names, as typed
+  rng = random.Random(0)
+  timings = []
+  for _ in range(suggestions if catalog.suggest_keys else 0):
+    prefix = rng.choice(catalog.suggest_keys)[:rng.randint(1, 4)]
+    start = time.perf_counter()
+    catalog.suggest(prefix, app.config['SUGGEST_LIMIT'])
+    timings.append((time.perf_counter() - start) * 10 ** 6)
+  if timings:
+    timings.sort()
+    click.echo('Suggestions of ' + str(len(timings)) + ' prefixes: p50 ' + str(round(percentile(timings, 50), 1)) + ' us, p99 ' + str(round(percentile(timings, 99), 1)) + ' us, max ' + str(round(max(timings), 1)) + ' us')
+
+def catalog_playlist(playlist_id):
+  return PlaylistSong.query.options(db.joinedload(PlaylistSong.song)).filter_by(playlistid=playlist_id)
+
+# Playlist operations, each runs in the caller's transaction
+
+# The first playlist of a user, created on demand
+def default_playlist(user_id):
+  playlist = Playlist.query.filter_by(userid=user_id).order_by(Playlist.id).first()
+  if not playlist:
+    playlist = Playlist(userid=user_id, name='My Playlist')
+    db.session.add(playlist)
+    db.session.flush()
+  return playlist
+
+# Append songs to a playlist in one batch, skipping unknown songs and songs already in it
+def add_playlist_songs(playlist_id, song_ids):
+  song_ids = set(song_ids)
+  known = set(db.session.scalars(db.select(Song.id).where(Song.id.in_(song_ids))))
+  present = set(db.session.scalars(db.select(PlaylistSong.songid).where(PlaylistSong.playlistid == playlist_id, PlaylistSong.songid.in_(song_ids))))
+  new_ids = sorted(known - present)
+  if new_ids:
+    last = db.session.scalar(db.select(db.func.max(PlaylistSong.position)).where(PlaylistSong.playlistid == playlist_id)) or 0
+    db.session.execute(db.insert(PlaylistSong), [{'playlistid': playlist_id, 'songid': song_id, 'position': last + playlist_gap * (i + 1)} for i, song_id in enumerate(new_ids)])
+    mark_similar_dirty(playlist_id, new_ids)
+  return len(new_ids)
+
+# Remove songs from a playlist in one batch
+def remove_playlist_songs(playlist_id, song_ids):
+  count = db.session.execute(db.delete(PlaylistSong).where(PlaylistSong.playlistid == playlist_id, PlaylistSong.songid.in_(set(song_ids)))).rowcount
+  if count:
+    mark_similar_dirty(playlist_id, song_ids)
+  return count
+
+# Spread the positions of a playlist out again, only needed when a gap is used up
+def renumber_playlist(playlist_id):
+  song_ids = db.session.scalars(db.select(PlaylistSong.songid).where(PlaylistSong.playlistid == playlist_id).order_by(PlaylistSong.position)).all()
+  db.session.execute(db.text('UPDATE playlist_song SET position = :position WHERE playlistid = :playlistid AND songid = :songid'),
+                     [{'playlistid': playlist_id, 'songid': song_id, 'position': playlist_gap * (i + 1)} for i, song_id in enumerate(song_ids)])
+
+# Move a song one place up (-1) or down (1), reading at most two neighbours through the position index
+def move_playlist_song(playlist_id, song_id, direction):
+  entry = PlaylistSong.query.filter_by(playlistid=playlist_id, songid=song_id).first()
+  if not entry:
+    return False
+  if direction < 0:
+    neighbours = PlaylistSong.query.filter(PlaylistSong.playlistid == playlist_id, PlaylistSong.position < entry.position).order_by(PlaylistSong.position.desc()).limit(2).all()
+  else:
+    neighbours = PlaylistSong.query.filter(PlaylistSong.playlistid == playlist_id, PlaylistSong.position > entry.position).order_by(PlaylistSong.position).limit(2).all()
+  if not neighbours:
+    return False
+  near = neighbours[0].position
+  far = neighbours[1].position if len(neighbours) > 1 else near + direction * 2 * playlist_gap
+  if abs(far - near) < 2:
+    renumber_playlist(playlist_id)
+    db.session.expire_all()
+    return move_playlist_song(playlist_id, song_id, direction)
+  entry.position = (near + far) // 2
+  return True
+
+# Sparse user x song matrix of saved songs, columns are song ids, a song in several playlists of a user counts once
+def saved_matrix(song_ids=None):
+  import numpy
+  import scipy.sparse
+  query = db.select(Playlist.userid, PlaylistSong.songid).join(Playlist, Playlist.id == PlaylistSong.playlistid).distinct()
+  # only the libraries of the listeners of the given songs, enough for their co-occurrence counts
+  if song_ids is not None:
+    listeners = db.select(Playlist.userid).join(PlaylistSong, Playlist.id == PlaylistSong.playlistid).where(PlaylistSong.songid.in_(song_ids))
+    query = query.where(Playlist.userid.in_(listeners))
+  pairs = db.session.execute(query).all()
+  pairs = numpy.array(pairs, dtype=numpy.int64).reshape(-1, 2)
+  users = numpy.unique(pairs[:, 0], return_inverse=True)[1]
+  shape = (users.max() + 1 if len(pairs) else 0, pairs[:, 1].max() + 1 if len(pairs) else 0)
+  return scipy.sparse.csc_matrix((numpy.ones(len(pairs), dtype=numpy.float32), (users, pairs[:, 1])), shape=shape)
+
+# Listeners of each of the given songs over the whole table, as an array indexed by song id
+def listener_counts(song_ids, size):
+  import numpy
+  counts = numpy.zeros(size, dtype=numpy.float32)
+  for chunk in chunked(song_ids, 500):
+    counts_query = (db.select(PlaylistSong.songid, db.func.count(db.distinct(Playlist.userid))).join(Playlist, Playlist.id == PlaylistSong.playlistid)
+                    .where(PlaylistSong.songid.in_(chunk)).group_by(PlaylistSong.songid))
+    for song_id, count in db.session.execute(counts_query):
+      counts[song_id] = count
+  return counts
+
+# Top k cosine similar songs of each of the given songs, as similar_song rows
+# counts are the listeners of every song, taken from the matrix when it holds every listener
+def similar_song_rows(matrix, song_ids, counts=None):
+  import numpy
+  k = app.config['SIMILAR_TOP_K']
+  norms = numpy.sqrt(numpy.asarray(matrix.sum(axis=0)).ravel() if counts is None else counts)
+  rows = []
+  song_ids = [song_id for song_id in song_ids if song_id < matrix.shape[1]]
+  for block in chunked(song_ids, app.config['SIMILAR_BLOCK']):
+    block = numpy.array(block)
+    # co-occurrence counts of the block against every song, one sparse product
+    counts = (matrix[:, block].T @ matrix).tocoo()
+    row, column, score = counts.row, counts.col, counts.data
+    keep = column != block[row]
+    row, column, score = row[keep], column[keep], score[keep] / (norms[block[row[keep]]] * norms[column[keep]])
+    # best first within each row, ties by song id, then the first k of every row
+    order = numpy.lexsort((column, -score, row))
+    row, column, score = row[order], column[order], score[order]
+    rank = numpy.arange(len(row)) - numpy.searchsorted(row, row)
+    keep = rank < k
+    rows.extend({'songid': int(song_id), 'rank': int(r), 'similarid': int(similar_id), 'score': float(value)}
+                for song_id, r, similar_id, value in zip(block[row[keep]], rank[keep], column[keep], score[keep]))
+  return rows
+
+# Replace the similar songs lists of the given songs
+def store_similar_songs(matrix, song_ids, counts=None):
+  for chunk in chunked(song_ids, 500):
+    db.session.execute(db.delete(SimilarSong).where(SimilarSong.songid.in_(chunk)))
+  rows = similar_song_rows(matrix, song_ids, counts)
+  if rows:
+    db.session.execute(db.insert(SimilarSong), rows)
+
+# Mark the lists moved by songs joining or leaving a playlist as out of date, within the request only the songs
+# themselves (flagged as changed) and the library of the playlist's owner, whose co-occurrences with them changed.
+# The lists of other listeners' songs that the songs' new listener counts move are found by the refresh
+def mark_similar_dirty(playlist_id, song_ids):
+  if not similar_available or not song_ids:
+    return
+  upsert = 'INSERT INTO similar_dirty (songid, version) {} ON CONFLICT (songid) DO UPDATE SET version = version + 1'
+  db.session.execute(db.text(upsert.format('''SELECT DISTINCT playlist_song.songid, 0 FROM playlist_song
+    JOIN playlist ON playlist.id = playlist_song.playlistid WHERE playlist.userid = (SELECT userid FROM playlist WHERE id = :id)''')), {'id': playlist_id})
+  db.session.execute(db.text('INSERT INTO similar_dirty (songid, version, changed) VALUES (:songid, 0, 1) ON CONFLICT (songid) DO UPDATE SET version = version + 1, changed = 1'),
+                     [{'songid': song_id} for song_id in set(song_ids)])
+
+# Songs whose list a changed song's new listener count moves: lists holding it (its score in them changed) and
+# lists it now scores into, at least as high as their last entry or into a list shorter than k
+def moved_similar_lists(song_ids):
+  import numpy
+  moved = set()
+  for chunk in chunked(song_ids, 500):
+    moved.update(db.session.scalars(db.select(SimilarSong.songid).where(SimilarSong.similarid.in_(chunk))))
+  matrix = saved_matrix(song_ids)
+  song_ids = numpy.array([song_id for song_id in song_ids if song_id < matrix.shape[1]], dtype=numpy.int64)
+  if not len(song_ids):
+    return moved
+  counts = listener_counts(numpy.flatnonzero(numpy.diff(matrix.indptr)).tolist(), matrix.shape[1])
+  norms = numpy.sqrt(counts)
+  # the changed songs' scores against every song co-saved with them, as in similar_song_rows
+  scores = (matrix[:, song_ids].T @ matrix).tocoo()
+  keep = scores.col != song_ids[scores.row]
+  column = scores.col[keep]
+  score = scores.data[keep] / (norms[song_ids[scores.row[keep]]] * norms[column])
+  best = {}
+  for song_id, value in zip(column.tolist(), score.tolist()):
+    best[song_id] = max(value, best.get(song_id, 0))
+  k = app.config['SIMILAR_TOP_K']
+  lasts = {}
+  for chunk in chunked(sorted(best), 500):
+    lasts.update((song_id, (count, last)) for song_id, count, last in db.session.execute(
+      db.select(SimilarSong.songid, db.func.count(), db.func.min(SimilarSong.score)).where(SimilarSong.songid.in_(chunk)).group_by(SimilarSong.songid)))
+  for song_id, value in best.items():
+    count, last = lasts.get(song_id, (0, None))
+    if count < k or value >= last:
+      moved.add(song_id)
+  return moved
+
+def mark_moved_similar_lists(changed, moved):
+  if moved:
+    db.session.execute(db.text('INSERT INTO similar_dirty (songid, version) VALUES (:songid, 0) ON CONFLICT (songid) DO UPDATE SET version = version + 1'),
+                       [{'songid': song_id} for song_id in sorted(moved)])
+  # songs changed again meanwhile keep their flag for the next run
+  db.session.execute(db.text('UPDATE similar_dirty SET changed = NULL WHERE songid = :songid AND version = :version'),
+                     [{'songid': song_id, 'version': version} for song_id, version in changed])
+  db.session.commit()
+
+# Recompute the out of date lists, runs once per batch of marks on the media worker pool
+similar_refresh_lock = threading.Lock()
+similar_refresh_queued = False
+
+def queue_similar_refresh():
+  global similar_refresh_queued
+  if not similar_available:
+    return
+  with similar_refresh_lock:
+    if similar_refresh_queued:
+      return
+    similar_refresh_queued = True
+  queue_media_job(refresh_similar_songs)
+
+def refresh_similar_songs():
+  global similar_refresh_queued
+  # marks made from here on queue another run
+  with similar_refresh_lock:
+    similar_refresh_queued = False
+  with app.app_context():
+    import numpy
+    changed = db.session.execute(db.select(SimilarDirty.songid, SimilarDirty.version).where(SimilarDirty.changed)).all()
+    for chunk in chunked(changed, app.config['SIMILAR_BLOCK']):
+      # read before the lists are recomputed, so the stored lists are the ones the changes moved
+      write_retry(mark_moved_similar_lists)(chunk, moved_similar_lists([song_id for song_id, version in chunk]))
+    dirty = db.session.execute(db.select(SimilarDirty.songid, SimilarDirty.version)).all()
+    for chunk in chunked(dirty, app.config['SIMILAR_BLOCK']):
+      # read after the marks, so every mark taken here is covered by the matrix. It holds the libraries of the
+      # listeners of the chunk's songs, the listener counts of the songs in it come from the whole table
+      matrix = saved_matrix([song_id for song_id, version in chunk])
+      counts = listener_counts(numpy.flatnonzero(numpy.diff(matrix.indptr)).tolist(), matrix.shape[1])
+      write_retry(store_similar_dirty)(matrix, counts, chunk)
+
+def store_similar_dirty(matrix, counts, dirty):
+  store_similar_songs(matrix, [song_id for song_id, version in dirty], counts)
+  for song_id, version in dirty:
+    mark_changed('similar:' + str(song_id))
+  # songs marked again meanwhile stay for the next run
+  db.session.execute(db.text('DELETE FROM similar_dirty WHERE songid = :songid AND version = :version'),
+                     [{'songid': song_id, 'version': version} for song_id, version in dirty])
+  db.session.commit()
+
+# Songs listeners of a song also saved, one lookup on the precomputed lists
+def similar_songs(song_id):
+  return db.session.execute(db.select(Song.id, Song.songname).join(SimilarSong, SimilarSong.similarid == Song.id)
+                            .where(SimilarSong.songid == song_id).order_by(SimilarSong.rank)).all()
+
+# Recompute the similar songs of every saved song
+@app.cli.command('build-similar')
+def build_similar_command():
+  if not similar_available:
+    raise click.ClickException('numpy and scipy are needed to compute similar songs.')
+  import numpy
+  start = time.perf_counter()
+  matrix = saved_matrix()
+  song_ids = numpy.flatnonzero(numpy.diff(matrix.indptr)).tolist()
+  # songs that had a list before may have none now
+  for song_id in set(song_ids).union(db.session.scalars(db.select(SimilarSong.songid).distinct())):
+    mark_changed('similar:' + str(song_id))
+  db.session.execute(db.delete(SimilarSong))
+  db.session.execute(db.delete(SimilarDirty))
+  store_similar_songs(matrix, song_ids)
+  db.session.commit()
+  click.echo('Computed similar songs of ' + str(len(song_ids)) + ' songs from ' + str(matrix.shape[0]) + ' listeners in ' + str(round(time.perf_counter() - start, 1)) + 's.')
+
+# Seconds in each rollup period
+play_periods = {'hour': 3600, 'day': 86400}
+
+# Ring buffer of (song id, unix time) play events, written behind by one thread per worker, sized by create_app
+play_buffer = deque()
+play_flusher = None
+play_lock = threading.Lock()
+play_wakeup = threading.Event()
+
+def record_play(song_id):
+  global play_flusher
+  if play_flusher is None:
+    with play_lock:
+      if play_flusher is None:
+        play_flusher = threading.Thread(target=play_flush_loop, name='plays', daemon=True)
+        play_flusher.start()
+  play_buffer.append((song_id, time.time()))
+  # flush early rather than let a burst push events out of the buffer
+  if len(play_buffer) * 2 >= play_buffer.maxlen:
+    play_wakeup.set()
+
+def play_flush_loop():
+  while True:
+    play_wakeup.wait(app.config['PLAY_FLUSH_SECONDS'])
+    play_wakeup.clear()
+    flush_plays()
+
+# Write out the buffered events, also run when the process exits
+@atexit.register
+def flush_plays():
+  events = [play_buffer.popleft() for _ in range(len(play_buffer))]
+  if not events:
+    return
+  with app.app_context():
+    try:
+      write_retry(store_plays)(events)
+    except Exception:
+      app.logger.exception('Dropped %d play events', len(events))
+
+# Add a batch of play events to the rollups, one upsert per table and period
+def store_plays(events):
+  song_ids = {song_id for song_id, when in events}
+  # events of songs deleted since are dropped here
+  songs = {id: (album_id, genre) for id, album_id, genre in db.session.execute(
+    db.select(Song.id, Album.id, Album.albumgenre).join(Album, Album.id == Song.album_id).where(Song.id.in_(song_ids)))}
+  counts = {'song': Counter(), 'album': Counter(), 'genre': Counter()}
+  played = 0
+  for song_id, when in events:
+    if song_id not in songs:
+      continue
+    played += 1
+    album_id, genre = songs[song_id]
+    for period, seconds in play_periods.items():
+      bucket = int(when // seconds * seconds)
+      counts['song'][(period, bucket, song_id)] += 1
+      counts['album'][(period, bucket, album_id)] += 1
+      counts['genre'][(period, bucket, genre)] += 1
+  for table, key in (('song_plays', 'songid'), ('album_plays', 'albumid'), ('genre_plays', 'genrename')):
+    kind = table.split('_')[0]
+    if counts[kind]:
+      db.session.execute(db.text('INSERT INTO ' + table + ' (period, bucket, ' + key + ', plays) VALUES (:period, :bucket, :key, :plays) '
+                                 'ON CONFLICT (period, bucket, ' + key + ') DO UPDATE SET plays = plays + excluded.plays'),
+                         [{'period': period, 'bucket': bucket, 'key': id, 'plays': plays} for (period, bucket, id), plays in counts[kind].items()])
+  bump_stat('plays', played)
+  db.session.commit()
+
+# Most played rows of a rollup model over the last hours (hour buckets) or days (day buckets)
+def top_chart(model, key, period, count):
+  since = int(time.time() // play_periods[period] * play_periods[period]) - (count - 1) * play_periods[period]
+  plays = db.func.sum(model.plays).label('plays')
+  return (db.select(key, plays).where(model.period == period, model.bucket >= since)
+          .group_by(key).order_by(plays.desc()).limit(app.config['CHART_SIZE']).subquery())
+
+# Top songs, albums and genres, read from the rollups only
+def top_charts(period, count):
+  songs = top_chart(SongPlays, SongPlays.songid, period, count)
+  albums = top_chart(AlbumPlays, AlbumPlays.albumid, period, count)
+  genres = top_chart(GenrePlays, GenrePlays.genrename, period, count)
+  return {
+    'songs': db.session.execute(db.select(Song.id, Song.songname, songs.c.plays).join(songs, songs.c.songid == Song.id).order_by(songs.c.plays.desc())).all(),
+    'albums': db.session.execute(db.select(Album.id, Album.albumname, Album.albumartist, albums.c.plays).join(albums, albums.c.albumid == Album.id).order_by(albums.c.plays.desc())).all(),
+    'genres': db.session.execute(db.select(genres.c.genrename, genres.c.plays).order_by(genres.c.plays.desc())).all(),
+  }
+
+# Keyset pagination on an increasing column, driven by the 'after' and 'before' cursors of the request
+def keyset_page(query, column):
+  size = app.config['PAGE_SIZE']
+  after = request.args.get('after', type=int)
+  before = request.args.get('before', type=int)
+  if before is not None:
+    # walk backwards from the cursor, then restore ascending order
+    items = query.filter(column < before).order_by(column.desc()).limit(size + 1).all()
+    more = len(items) > size
+    items = items[:size][::-1]
+    has_prev, has_next = more, True
+  else:
+    if after is not None:
+      query = query.filter(column > after)
+    items = query.order_by(column).limit(size + 1).all()
+    more = len(items) > size
+    items = items[:size]
+    has_prev, has_next = after is not None, more
+  key = column.key
+  return {
+    'items': items,
+    # other query arguments, kept on the previous / next links
+    'args': {name: value for name, value in request.args.items() if name not in ('after', 'before')},
+    'prev': getattr(items[0], key) if items and has_prev else None,
+    'next': getattr(items[-1], key) if items and has_next else None,
+  }
+
+# Load the logged in user once per request and share it between decorators and views
+def current_user():
+  user_id = session.get('user_id')
+  # keyed by id, requests driven from a CLI command all share the command's g
+  if 'current_user' not in g or g.current_user_id != user_id:
+    g.current_user_id = user_id
+    g.current_user = User.query.get(user_id) if user_id else None
+  return g.current_user
+
+# Short lived cache of role flags, user id -> (expiry, isadmin, iscreator)
+role_cache = {}
+
+# Role flags of the logged in user, served from the role cache while fresh
+def current_roles():
+  user_id = session['user_id']
+  cached = role_cache.get(user_id)
+  if cached and cached[0] > time.monotonic():
+    return cached[1], cached[2]
+  user = current_user()
+  ttl = app.config['ROLE_CACHE_TTL']
+  if ttl:
+    role_cache[user_id] = (time.monotonic() + ttl, user.isadmin, user.iscreator)
+  return user.isadmin, user.iscreator
+
+# Drop the cached role flags of a user after they change
+def invalidate_roles(user_id):
+  role_cache.pop(user_id, None)
+  # the navigation of the user's pages follows their roles
+  mark_changed('user:' + str(user_id))
+
+# Define a decorator for GET pages answered with 304 Not Modified while the named page versions are unchanged
+# ('user' stands for the signed in user's own version, 'similar' for the similar songs of the song the user saved
+# last, if any), the view, its queries and its template are skipped on a hit.
+# Runs ahead of the login and role checks, a tag is only ever handed out by a full render the user was allowed to see.
+# Every page using it shows the signed in user's data, which their own posts change right before redirecting back
+# to it, so the pages are private and revalidated on every visit (no-cache) rather than cached for a time
+conditional_pages = []
+
+def page_version_names(names):
+  for name in names:
+    if name == 'user':
+      yield 'user:' + str(session['user_id'])
+    elif name == 'similar':
+      if 'saved_song_id' in session:
+        yield 'similar:' + str(session['saved_song_id'])
+    else:
+      yield name
+
+def conditional_page(*names, cache_control='private, no-cache'):
+  def decorator(func):
+    conditional_pages.append(func.__name__)
+    @wraps(func)
+    def inner(*args, **kwargs):
+      # pending flashed messages have to reach a fresh render
+      if 'user_id' not in session or '_flashes' in session:
+        return func(*args, **kwargs)
+      versions = get_page_versions()
+      changes = [versions.get(name) for name in page_version_names(names)]
+      key = [versions.epoch, request.endpoint, session['user_id'], session.get('saved_song_id')] + changes
+      etag = format(zlib.crc32(repr(key).encode()), '08x') + format(max(changes), 'x')
+      # Last-Modified has whole seconds, it is only handed out (and If-Modified-Since only answered) once the
+      # second of the version is over, so no later change can share the date a client revalidates with
+      last_modified = datetime.fromtimestamp(max(changes) // 10 ** 9, timezone.utc) if max(changes) // 10 ** 9 < time.time_ns() // 10 ** 9 else None
+      if request.if_none_match.contains_weak(etag) or (not request.if_none_match and last_modified and request.if_modified_since and request.if_modified_since >= last_modified):
+        response = Response(status=304)
+      else:
+        response = app.make_response(func(*args, **kwargs))
+        if response.status_code != 200:
+          return response
+      response.set_etag(etag)
+      if last_modified:
+        response.last_modified = last_modified
+      response.headers['Cache-Control'] = cache_control
+      return response
+    return inner
+  return decorator
+
+# Define a decorator for route functions whose short write transaction is retried while the database is locked
+def write_retry(func):
+  @wraps(func)
+  def inner(*args, **kwargs):
+    for attempt in range(app.config['WRITE_RETRIES']):
+      try:
+        return func(*args, **kwargs)
+      except OperationalError as error:
+        db.session.rollback()
+        if 'database is locked' not in str(error) or attempt == app.config['WRITE_RETRIES'] - 1:
+          raise
+        # back off a little longer after each failed attempt
+        time.sleep(0.05 * 2 ** attempt)
+  return inner
+
 # Define a decorator for route functions that require authentication
 def auth_required(func):
   @wraps(func)
@@ -136,62 +2127,301 @@ def admin_required(func):
     if 'user_id' not in session:
       flash('You need to login first.')
       return redirect (url_for('login_page'))
-    user = User.query.get(session['user_id'])
+    isadmin, iscreator = current_roles()
     # prevent unauthorised access
-    if not user.isadmin:
+    if not isadmin:
       flash('You are not authorised to view this page.')
       return redirect(url_for('index_page'))
     return func(*args, **kwargs)
   return inner
 
+# Audio file types accepted for song uploads
+media_extensions = {'.mp3', '.ogg', '.oga', '.opus', '.flac', '.wav', '.m4a', '.aac'}
+
+# Temporary upload file that hashes what is written to it
+class HashingFile:
+  def __init__(self, folder):
+    # removed when the request closes, kept files are hard linked into the blob store first
+    self.file = tempfile.NamedTemporaryFile('wb+', dir=folder, suffix='.part')
+    self.hash = hashlib.sha256()
+
+  def write(self, data):
+    self.hash.update(data)
+    return self.file.write(data)
+
+  def __getattr__(self, name):
+    return getattr(self.file, name)
+
+# Requests spool uploaded files straight to disk in the form parser's 64 KiB chunks, never in memory
+class MediaRequest(Request):
+  def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+    folder = os.path.join(app.config['MEDIA_FOLDER'], 'uploads')
+    os.makedirs(folder, exist_ok=True)
+    return HashingFile(folder)
+
+app.request_class = MediaRequest
+
+# Content addressed blob store, a file lives at blobs/<2 hex>/<2 hex>/<sha256><extension>
+# under the media folder (audio) or the lyrics folder (lyrics), paths elsewhere are not managed
+blob_roots = {'audio': 'MEDIA_FOLDER', 'lyrics': 'LYRICS_FOLDER'}
+blob_ref_upsert = '''INSERT INTO blob (kind, path, size, refcount) VALUES (:kind, :path, :size, 1)
+  ON CONFLICT (kind, path) DO UPDATE SET refcount = refcount + 1, size = MAX(size, excluded.size)'''
+
+def blob_path(digest, extension):
+  return 'blobs/' + digest[:2] + '/' + digest[2:4] + '/' + digest + extension
+
+def blob_file(kind, path):
+  return os.path.join(app.config[blob_roots[kind]], path)
+
+# The (kind, path) pairs a song references
+def song_blobs(song):
+  return [('audio', song.songaudio_path), ('lyrics', song.songlyrics_path)]
+
+# Take one more reference on each store path of the given (kind, path) pairs
+def ref_blobs(pairs):
+  rows = [{'kind': kind, 'path': path, 'size': 0} for kind, path in pairs if path and path.startswith('blobs/')]
+  if rows:
+    db.session.execute(db.text(blob_ref_upsert), rows)
+
+def release_blobs(pairs):
+  rows = [{'kind': kind, 'path': path} for kind, path in pairs if path and path.startswith('blobs/')]
+  if rows:
+    db.session.execute(db.text('UPDATE blob SET refcount = refcount - 1 WHERE kind = :kind AND path = :path'), rows)
+
+# Put a local file into the store under the given digest and take a reference on it, returns the store path
+# link is a hard link when the file can be shared in place, a copy otherwise
+def store_blob(kind, source, digest, extension, size, link=True):
+  path = blob_path(digest, extension)
+  # the reference is written first, the database write lock it holds keeps a collection from removing the file meanwhile
+  db.session.execute(db.text(blob_ref_upsert), {'kind': kind, 'path': path, 'size': size})
+  dest = blob_file(kind, path)
+  if not os.path.exists(dest):
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    if link:
+      try:
+        os.link(source, dest)
+      except FileExistsError:
+        pass
+    else:
+      shutil.copyfile(source, dest + '.part')
+      os.replace(dest + '.part', dest)
+  return path
+
+# Store an uploaded file, identical uploads share one blob
+def store_upload(kind, file, extension):
+  file.stream.flush()
+  return store_blob(kind, file.stream.name, file.stream.hash.hexdigest(), extension, os.fstat(file.stream.fileno()).st_size)
+
+# SHA-256 of a file, read in chunks
+def file_digest(path):
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(1024 * 1024), b''):
+      digest.update(block)
+  return digest.hexdigest()
+
+# Remove up to limit unreferenced blobs, returns how many were removed
+@write_retry
+def collect_blobs(limit):
+  rows = db.session.execute(db.text('''DELETE FROM blob WHERE rowid IN (SELECT rowid FROM blob WHERE refcount <= 0 LIMIT :limit)
+    RETURNING kind, path'''), {'limit': limit}).all()
+  # files go while the write lock is held, a new reference to the same content waits and links it again
+  for kind, path in rows:
+    try:
+      os.remove(blob_file(kind, path))
+    except FileNotFoundError:
+      pass
+  db.session.commit()
+  return len(rows)
+
+# Send the client back to the form when an upload is over the size cap
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(error):
+  flash('The uploaded file is too large.')
+  return redirect(request.path)
+
+# Duration in seconds, bitrate and sample rate of an audio file, None when it can't be read
+def read_media_metadata(path):
+  if mutagen is not None:
+    audio = mutagen.File(path)
+    if audio is None or audio.info is None:
+      return None
+    return {'duration': audio.info.length, 'bitrate': getattr(audio.info, 'bitrate', None),
+            'samplerate': getattr(audio.info, 'sample_rate', None)}
+  if not path.lower().endswith('.wav'):
+    return None
+  with wave.open(path) as audio:
+    rate = audio.getframerate()
+    return {'duration': audio.getnframes() / rate, 'bitrate': rate * audio.getsampwidth() * 8 * audio.getnchannels(), 'samplerate': rate}
+
+# Whether read_media_metadata can read files with this extension at all
+def media_metadata_readable(extension):
+  return mutagen is not None or extension == '.wav'
+
+@write_retry
+def save_song_metadata(song_id, path, metadata):
+  song = db.session.get(Song, song_id)
+  # the song was deleted or given another file in the meantime
+  if song is None or song.songaudio_path != path:
+    return
+  seconds = min(int(round(metadata['duration'])), 24 * 3600 - 1)
+  song.songduration = datetime.min.replace(hour=seconds // 3600, minute=seconds // 60 % 60, second=seconds % 60).time()
+  song.songbitrate = metadata['bitrate'] or None
+  song.songsamplerate = metadata['samplerate'] or None
+  bump_catalog(song.album_id)
+  db.session.commit()
+
+def extract_song_metadata(song_id, path):
+  try:
+    metadata = read_media_metadata(os.path.join(app.config['MEDIA_FOLDER'], path))
+  except Exception:
+    app.logger.exception('Could not read metadata of %s', path)
+    return
+  if not metadata:
+    app.logger.warning('No metadata found in %s, song %s keeps its entered duration', path, song_id)
+    return
+  with app.app_context():
+    save_song_metadata(song_id, path, metadata)
+
+def collect_blobs_batch():
+  with app.app_context():
+    collect_blobs(app.config['BLOB_GC_BATCH'])
+
+# Thread pool for metadata extraction and blob collection, created on first use in each worker
+media_pool = None
+media_pool_lock = threading.Lock()
+
+def queue_media_job(func, *args):
+  global media_pool
+  if not app.config['MEDIA_WORKERS']:
+    return func(*args)
+  with media_pool_lock:
+    if media_pool is None:
+      media_pool = ThreadPoolExecutor(max_workers=app.config['MEDIA_WORKERS'], thread_name_prefix='media')
+  media_pool.submit(func, *args)
+
+# Remove unreferenced blobs batch by batch, each batch in its own short transaction
+@app.cli.command('gc-media')
+@click.option('--batches', default=0, help='Batches to run, 0 runs until nothing is left.')
+def gc_media_command(batches):
+  total = done = 0
+  while not batches or done < batches:
+    removed = collect_blobs(app.config['BLOB_GC_BATCH'])
+    total += removed
+    done += 1
+    if removed < app.config['BLOB_GC_BATCH']:
+      break
+  click.echo('Removed ' + str(total) + ' unreferenced blobs.')
+
+# Move the loose audio and lyrics files songs point at into the blob store, identical files become one blob
+@app.cli.command('store-media')
+@click.option('--remove/--keep', default=False, help='Remove the loose files once every song points into the store.')
+def store_media_command(remove):
+  stored = {}
+  missing = set()
+  songs = db.session.execute(db.select(Song.id, Song.songaudio_path, Song.songlyrics_path, Song.album_id).order_by(Song.id)).all()
+  for chunk in chunked(songs, 1000):
+    rows = []
+    album_ids = set()
+    for id, audio_path, lyrics_path, album_id in chunk:
+      paths = {'audio': audio_path, 'lyrics': lyrics_path}
+      for kind, path in paths.items():
+        if not path or path.startswith('blobs/') or (kind, path) in missing:
+          continue
+        if (kind, path) in stored:
+          ref_blobs([(kind, stored[(kind, path)])])
+        else:
+          source = blob_file(kind, path)
+          if not os.path.isfile(source):
+            missing.add((kind, path))
+            continue
+          # a copy, the loose file may still be changed or removed in place
+          stored[(kind, path)] = store_blob(kind, source, file_digest(source), os.path.splitext(path)[1].lower(), os.path.getsize(source), link=False)
+        paths[kind] = stored[(kind, path)]
+      if (paths['audio'], paths['lyrics']) != (audio_path, lyrics_path):
+        rows.append({'id': id, 'audio': paths['audio'], 'lyrics': paths['lyrics']})
+        album_ids.add(album_id)
+    if rows:
+      db.session.execute(db.text('UPDATE song SET songaudio_path = :audio, songlyrics_path = :lyrics WHERE id = :id'), rows)
+      bump_catalog(*album_ids)
+    db.session.commit()
+  if remove:
+    for kind, path in stored:
+      os.remove(blob_file(kind, path))
+  click.echo('Stored ' + str(len(stored)) + ' files as ' + str(len(set(stored.values()))) + ' blobs, ' + str(len(missing)) + ' missing.')
+
 # Define the route for the home page
 @app.route('/')
+@conditional_page('catalog', 'similar', 'user')
 @auth_required
 def index_page():
-    user = User.query.get(session['user_id'])
     # admin home page
-    if user.isadmin:
+    if current_roles()[0]:
         return redirect(url_for('admin_page'))
+    user = current_user()
     parameter = request.args.get('parameter')
     search = request.args.get('search')
-    # search fucntioning
-    if not parameter or not search:
-        return render_template("index.html", user=user, albums=Album.query.all())
-    if parameter == 'album':
-        albums = Album.query.filter(Album.albumname.like('%' + search + '%')).all()
-        return render_template('index.html', user=user, albums=albums)
-    if parameter == 'song':
-        # Assuming you want to filter by song name
-        songs = Song.query.filter(Song.songname.like('%' + search + '%')).all()
-        # If you want to show albums containing those songs
-        albums = [song.album for song in songs]
-        return render_template('index.html', user=user, albums=albums)
-    return render_template('index.html', user=user, albums=Album.query.all(), songs=Song.query.all())
+    # search fucntioning, the album list is rendered once per catalog version and shared between users
+    if parameter == 'album' and search:
+        albums_html = cached_fragment(lambda: render_template('album_list.html', page={'items': catalog_search_albums(search)}))
+        return render_template('index.html', user=user, albums_html=albums_html)
+    if parameter == 'song' and search:
+        # show albums containing the songs matching by song name
+        albums_html = cached_fragment(lambda: render_template('album_list.html', page={'items': catalog_song_albums(search)}))
+        return render_template('index.html', user=user, albums_html=albums_html)
+    albums_html = cached_fragment(lambda: render_template('album_list.html', page=catalog_albums()))
+    # songs saved along with the last song this user saved
+    similar = similar_songs(session['saved_song_id']) if 'saved_song_id' in session else []
+    return render_template("index.html", user=user, albums_html=albums_html, similar=similar)
 
 # Define the route for the admin page
 @app.route('/admin')
 @admin_required
 def admin_page():
-    user = User.query.get(session['user_id'])
+    user = current_user()
     # avoid unauthorised viewing
     if not user.isadmin:
         flash('You are not authorised to view this page.')
         return redirect(url_for('index_page'))
-    # keeping track of number of users, creators
-    creators_count = User.query.filter_by(iscreator=True).count()
-    return render_template("admin.html", user=user, users=User.query.all(), songs=Song.query.all(), albums=Album.query.all(), creators_count=creators_count, genres=Genre.query.all())
+    # keeping track of number of users, creators, songs, albums and genres
+    return render_template("admin.html", user=user, stats=get_stats())
+
+# Define the route for the top charts (authenticated users only)
+# today covers the last 24 hour buckets, week and month the last 7 and 30 day buckets
+chart_windows = {'today': ('hour', 24), 'week': ('day', 7), 'month': ('day', 30)}
+
+@app.route('/charts')
+@auth_required
+def charts_page():
+    window = request.args.get('window')
+    if window not in chart_windows:
+        window = 'today'
+    return render_template('charts.html', user=current_user(), window=window, windows=chart_windows, charts=top_charts(*chart_windows[window]))
+
+# Define the route for the performance panel (admin only)
+@app.route('/admin/performance')
+@admin_required
+def admin_performance_page():
+    return render_template('admin_performance.html', user=current_user(), report=metrics_report())
+
+# Define the route for the machine readable metrics (admin only)
+@app.route('/admin/metrics')
+@admin_required
+def admin_metrics_page():
+    return jsonify(metrics_report())
 
 # Define the route for the profile page
 @app.route('/profile')
 @auth_required
 def profile_page():
-  return render_template("profile.html", user=User.query.get(session['user_id']))
+  return render_template("profile.html", user=current_user())
 
 # Define the route for updating profile information
 @app.route('/profile', methods=['POST'])
 @auth_required
+@write_retry
 def profile_page_post():
-    user = User.query.get(session['user_id'])
+    user = current_user()
     username = request.form.get('username')
     name = request.form.get('name')
     password = request.form.get('password')
@@ -200,7 +2430,7 @@ def profile_page_post():
     if username == '' or password == '' or cpassword == '':
         flash('Username or password cannot be empty.')
         return redirect(url_for('profile_page'))
-    if not user.check_password(cpassword):
+    if not verify_password(user.passhash, cpassword):
         flash('Incorrect password.')
         return redirect(url_for('profile_page'))
     if User.query.filter_by(username=username).first() and username != user.username:
@@ -209,8 +2439,9 @@ def profile_page_post():
     # storing the information after validity check
     user.username = username
     user.name = name
-    user.password = password
+    user.passhash = hash_password(password)
     db.session.commit()
+    invalidate_roles(user.id)
     flash('Profile updated successfully.')
     return redirect(url_for('profile_page'))
 
@@ -221,6 +2452,7 @@ def login_page():
 
 # Define the route for processing login information
 @app.route('/login', methods=['POST'])
+@write_retry
 def login_page_post():
     username = request.form.get('username')
     password = request.form.get('password')
@@ -232,9 +2464,13 @@ def login_page_post():
     if not user:
         flash('User does not exist.')
         return redirect(url_for('login_page'))
-    if not user.check_password(password):
+    if not verify_password(user.passhash, password):
         flash('Incorrect password.')
         return redirect(url_for('login_page'))
+    # upgrade hashes made with older parameters while the password is at hand
+    if password_needs_rehash(user.passhash):
+        user.passhash = hash_password(password)
+        db.session.commit()
     session['user_id'] = user.id
     return redirect(url_for('index_page'))
 
@@ -245,6 +2481,7 @@ def register_page():
 
 # Define the route for processing user registration
 @app.route('/register', methods=['POST'])
+@write_retry
 def register_page_post():
     username = request.form.get('username')
     password = request.form.get('password')
@@ -257,8 +2494,9 @@ def register_page_post():
         flash('User with this username already exists. Please choose some other username.')
         return redirect(url_for('register_page'))
     # storing the information after validity check
-    user = User(username=username, password=password, name=name)
+    user = User(username=username, passhash=hash_password(password), name=name)
     db.session.add(user)
+    bump_stat('users')
     db.session.commit()
     flash('User successfully registered.')
     return redirect(url_for('login_page'))
@@ -273,13 +2511,14 @@ def logout_page():
 @app.route('/genres')
 @admin_required
 def genres_page():
-    return render_template('genres.html', user=User.query.get(session['user_id']), users=User.query.all(), songs=Song.query.all(), albums=Album.query.all(), genres=Genre.query.all())
+    page = catalog_genres()
+    return render_template('genres.html', user=current_user(), genres=page['items'], page=page)
 
 # Define the route for adding a new genre (admin only)
 @app.route('/genre/add')
 @admin_required
 def add_genre_page():
-  return render_template('genre/add_genre.html', user=User.query.get(session['user_id']))
+  return render_template('genre/add_genre.html', user=current_user())
 
 # Define the route for processing the addition of a new genre (admin only)
 @app.route('/genre/add', methods=['POST'])
@@ -293,9 +2532,14 @@ def add_genre_page_post():
     if len(name) > 50:
         flash('Genre name can not be greater than 50 characters.')
         return redirect(url_for('add_genre_page'))
+    if Genre.query.filter_by(genrename=name).first():
+        flash('Genre with this name already exists.')
+        return redirect(url_for('add_genre_page'))
     # storing genre information after validity check
     genre = Genre(genrename=name)
     db.session.add(genre)
+    bump_stat('genres')
+    bump_catalog(genres=True)
     db.session.commit()
     flash('Genre added successfully.')
     return redirect(url_for('admin_page'))
@@ -304,13 +2548,16 @@ def add_genre_page_post():
 @app.route('/genre/<int:id>/edit')
 @admin_required
 def edit_genre_page(id):
-  return render_template('genre/edit_genre.html', user=User.query.get(session['user_id']), genre=Genre.query.get(id))
+  return render_template('genre/edit_genre.html', user=current_user(), genre=Genre.query.get(id))
 
 # Define the route for processing the edit form for an genre (admin only)
 @app.route('/genre/<int:id>/edit', methods=['POST'])
 @admin_required
 def edit_genre_page_post(id):
-    genre = genre.query.get(id)
+    genre = Genre.query.get(id)
+    if not genre:
+        flash('Genre does not exist.')
+        return redirect(url_for('admin_page'))
     name = request.form.get('name')
     # checking genre details for valid updation
     if name == '':
@@ -318,9 +2565,13 @@ def edit_genre_page_post(id):
         return redirect(url_for('edit_genre_page', id=id))
     if len(name) > 50:
         flash('Genre name can not be greater than 50 characters.')
-        return redirect(url_for('edit_Genre_page', id=id))
+        return redirect(url_for('edit_genre_page', id=id))
+    if Genre.query.filter(Genre.genrename == name, Genre.id != id).first():
+        flash('Genre with this name already exists.')
+        return redirect(url_for('edit_genre_page', id=id))
     # updating genre details after validity check
     genre.genrename = name
+    bump_catalog(genres=True)
     db.session.commit()
     flash('Genre updated successfully.')
     return redirect(url_for('admin_page'))
@@ -333,7 +2584,7 @@ def delete_genre_page(id):
     if not genre:
         flash('Genre does not exist.')
         return redirect(url_for('admin_page'))
-    return render_template('genre/delete_genre.html', user=User.query.get(session['user_id']), genre=genre)
+    return render_template('genre/delete_genre.html', user=current_user(), genre=genre)
 
 # Define the route for processing the deletion of an genre (admin only)
 @app.route('/genre/<int:id>/delete', methods=['POST'])
@@ -344,21 +2595,25 @@ def delete_genre_page_post(id):
     flash('Genre does not exist.')
     return redirect(url_for('admin_page'))
   db.session.delete(genre)
+  bump_stat('genres', -1)
+  bump_catalog(genres=True)
   db.session.commit()
   flash('Genre deleted successfully')
   return redirect(url_for('admin_page'))
 
 # Define the route for the albums page (admin only)
 @app.route('/albums')
+@conditional_page('catalog', 'user')
 @admin_required
 def albums_page():
-    return render_template('albums.html', user=User.query.get(session['user_id']), users=User.query.all(), songs=Song.query.all(), albums=Album.query.all())
+    page = catalog_albums()
+    return render_template('albums.html', user=current_user(), albums=page['items'], page=page)
 
 # Define the route for adding a new album (admin only)
 @app.route('/album/add')
 @admin_required
 def add_album_page():
-  return render_template('album/add_album.html', user=User.query.get(session['user_id']))
+  return render_template('album/add_album.html', user=current_user())
 
 # Define the route for processing the addition of a new album (admin only)
 @app.route('/album/add', methods=['POST'])
@@ -377,6 +2632,10 @@ def add_album_page_post():
     # storing album information after validity check
     album = Album(albumname=name, albumgenre=genre, albumartist=artist)
     db.session.add(album)
+    bump_stat('albums')
+    db.session.flush()
+    index_album(album.id)
+    bump_catalog(album.id)
     db.session.commit()
     flash('Album added successfully.')
     return redirect(url_for('admin_page'))
@@ -385,14 +2644,14 @@ def add_album_page_post():
 @app.route('/album/<int:id>/open')
 @admin_required
 def open_album_page(id):
-  return render_template('album/open_album.html', user=User.query.get(session['user_id']), album=Album.query.get(id))
+  return render_template('album/open_album.html', user=current_user(), album=catalog_album(id))
 
 # Define the route for adding a new song (admin only)
 @app.route('/song/add-song')
 @admin_required
 def add_song_page():
     album_id = request.args.get('album_id', type=int, default=-1)
-    return render_template('song/add_song.html', user=User.query.get(session['user_id']), album=Album.query.get(album_id), albums=Album.query.all())
+    return render_template('song/add_song.html', user=current_user(), album=Album.query.get(album_id))
 
 # Define the route for processing the addition of a new song (admin only)
 @app.route('/song/add-song', methods=['POST'])
@@ -419,6 +2678,10 @@ def add_song_page_post():
     # storing song information after validity check
     song = Song(songname=name, album_id=album_id, songduration=songduration, songdateofcreation=songdateofcreation)
     db.session.add(song)
+    bump_stat('songs')
+    db.session.flush()
+    index_song(song.id)
+    bump_catalog(album_id)
     db.session.commit()
     flash('Song added successfully.')
     return redirect(url_for('open_album_page', id=album.id))
@@ -431,14 +2694,14 @@ def open_song_page(id):
     if not song:
         flash('Song does not exist.')
         return redirect(url_for('admin_page'))
-    return render_template('song/open_song.html', user=User.query.get(session['user_id']), song=song)
+    return render_template('song/open_song.html', user=current_user(), song=song, lyrics=load_lyrics(song))
 
 # Define the route for updating an existing song (admin only)
 @app.route('/song/<int:id>/edit-song')
 @admin_required
 def edit_song_page(id):
     song = Song.query.get(id)
-    return render_template('song/edit_song.html', user=User.query.get(session['user_id']), song=song, albums=Album.query.all())
+    return render_template('song/edit_song.html', user=current_user(), song=song)
 
 # Define the route for processing the updating of an existing song (admin only)
 @app.route('/song/<int:id>/edit-song', methods=['POST'])
@@ -464,22 +2727,120 @@ def edit_song_page_post(id):
         return redirect(url_for('add_song_page'))
     # updating song details after validity check
     song = Song.query.get(id)
+    # both albums change when the song moves
+    bump_catalog(song.album_id, album_id)
     song.songname = name
     song.album_id = album_id
     song.songduration = songduration
     song.songdateofcreation = songdateofcreation
+    index_song(song.id)
     db.session.commit()
     flash('Song updated successfully.')
     return redirect(url_for('open_album_page', id=album.id))
 
 
-#Additional routes (commented out for now)
-'''
+# Define the route for streaming the audio of a song
+# send_from_directory answers Range requests with 206 partial content, handles ETag / Last-Modified
+# conditional requests and hands the open file to the server's file wrapper (sendfile) instead of reading it
 @app.route('/song/<int:id>/listen-song')
-@admin_required
+@auth_required
 def listen_song_page(id):
-  return "LISTEN"
+    song = Song.query.get(id)
+    if not song or not song.songaudio_path:
+        flash('Song audio does not exist.')
+        return redirect(url_for('index_page'))
+    return send_from_directory(app.config['MEDIA_FOLDER'], song.songaudio_path, conditional=True, max_age=3600)
+
+# Seek concurrently within a large temporary track through listen_song_page, failing unless every Range request
+# is a 206 with the right bytes, a range past the end a 416 and a revalidation with the ETag or Last-Modified a 304.
+# A scratch song in the first album points at the track for the duration of the check
+@app.cli.command('check-range-requests')
+@click.option('--size-mb', default=64, help='Size of the temporary track.')
+@click.option('--clients', default=16, help='Clients seeking at the same time.')
+@click.option('--requests', 'count', default=50, help='Range requests per client.')
+def check_range_requests_command(size_mb, clients, count):
+  album = Album.query.order_by(Album.id).first()
+  user = User.query.order_by(User.id).first()
+  if not album or not user:
+    raise click.ClickException('The check needs an album and a user, run flask bootstrap and add an album first.')
+  size = size_mb * 1024 * 1024
+  media_folder = app.config['MEDIA_FOLDER']
+  folder = tempfile.mkdtemp()
+  path = os.path.join(folder, 'track.mp3')
+  with open(path, 'wb') as f:
+    for _ in range(size_mb):
+      f.write(os.urandom(1024 * 1024))
+  song = Song(songname='Range check', album_id=album.id, songaudio_path='track.mp3', songduration=datetime.min.time(), songdateofcreation=date.today())
+  db.session.add(song)
+  db.session.commit()
+  app.config['MEDIA_FOLDER'] = folder
+  url = '/song/' + str(song.id) + '/listen-song'
+  user_id = user.id
+  failures = []
+  lock = threading.Lock()
+  def seek(n):
+    rng = random.Random(n)
+    client = bench_client(user_id)
+    with open(path, 'rb') as f:
+      for _ in range(count):
+        start = rng.randrange(size)
+        end = min(size - 1, start + rng.randrange(1024 * 1024))
+        # closed, open ended and suffix ranges
+        kind = rng.choice(['closed', 'open', 'suffix'])
+        if kind == 'open':
+          start = max(start, size - 1024 * 1024)
+          end = size - 1
+          header = 'bytes=' + str(start) + '-'
+        elif kind == 'suffix':
+          start = size - (end - start + 1)
+          end = size - 1
+          header = 'bytes=-' + str(end - start + 1)
+        else:
+          header = 'bytes=' + str(start) + '-' + str(end)
+        response = client.get(url, headers={'Range': header})
+        f.seek(start)
+        ok = (response.status_code == 206 and response.headers.get('Content-Range') == 'bytes ' + str(start) + '-' + str(end) + '/' + str(size)
+              and response.get_data() == f.read(end - start + 1))
+        if not ok:
+          with lock:
+            failures.append(header + ' -> ' + str(response.status_code) + ' ' + str(response.headers.get('Content-Range')))
+  try:
+    workers = [threading.Thread(target=seek, args=(n,)) for n in range(clients)]
+    started = time.perf_counter()
+    for worker in workers:
+      worker.start()
+    for worker in workers:
+      worker.join()
+    elapsed = time.perf_counter() - started
+    client = bench_client(user_id)
+    head = client.head(url)
+    checks = {
+      'range past the end': client.get(url, headers={'Range': 'bytes=' + str(size) + '-'}).status_code == 416,
+      'If-None-Match': client.get(url, headers={'If-None-Match': head.headers.get('ETag', '')}).status_code == 304,
+      'If-Modified-Since': client.get(url, headers={'If-Modified-Since': head.headers.get('Last-Modified', '')}).status_code == 304,
+    }
+    failures += [name + ' not answered as expected' for name, ok in checks.items() if not ok]
+  finally:
+    app.config['MEDIA_FOLDER'] = media_folder
+    db.session.delete(song)
+    db.session.commit()
+    shutil.rmtree(folder, ignore_errors=True)
+  for failure in failures[:20]:
+    click.echo('FAIL ' + failure)
+  click.echo(str(clients * count) + ' range requests in ' + str(round(elapsed, 2)) + ' s, ' + str(len(failures)) + ' failures.')
+  if failures:
+    raise SystemExit(1)
+
+# Define the route for recording that a song was played (authenticated users only)
+# buffered and written behind in batches, a play never costs a database write of its own
+@app.route('/song/<int:id>/play', methods=['POST'])
+@auth_required
+def play_song_page(id):
+    record_play(id)
+    return '', 204
 
+#Additional routes (commented out for now)
+'''
 @app.route('/song/<int:id>/lyrics-song')
 @admin_required
 def lyrics_song_page(id):
@@ -494,7 +2855,7 @@ def delete_song_page(id):
     if not song:
         flash('Song does not exist.')
         return redirect(url_for('admin_page'))
-    return render_template('song/delete_song.html', user=User.query.get(session['user_id']), song=song)
+    return render_template('song/delete_song.html', user=current_user(), song=song)
 
 # Define the route for processing the deletion of a song (admin only)
 @app.route('/song/<int:id>/delete-song', methods=['POST'])
@@ -504,8 +2865,14 @@ def delete_song_page_post(id):
   if not song:
     flash('Song does not exist.')
     return redirect(url_for('admin_page'))
+  unindex_song(song.id)
+  release_blobs(song_blobs(song))
   db.session.delete(song)
+  bump_stat('songs', -1)
+  bump_catalog(song.album_id)
   db.session.commit()
+  # files nobody references any more are removed in the background
+  queue_media_job(collect_blobs_batch)
   flash('Song deleted successfully')
   return redirect(url_for('admin_page'))
 
@@ -513,7 +2880,7 @@ def delete_song_page_post(id):
 @app.route('/album/<int:id>/edit')
 @admin_required
 def edit_album_page(id):
-  return render_template('album/edit_album.html', user=User.query.get(session['user_id']), album=Album.query.get(id))
+  return render_template('album/edit_album.html', user=current_user(), album=Album.query.get(id))
 
 # Define the route for processing the edit form for an album (admin only)
 @app.route('/album/<int:id>/edit', methods=['POST'])
@@ -534,6 +2901,8 @@ def edit_album_page_post(id):
     album.albumname = name
     album.albumgenre = genre
     album.albumartist = artist
+    index_album(album.id)
+    bump_catalog(album.id)
     db.session.commit()
     flash('Album updated successfully.')
     return redirect(url_for('admin_page'))
@@ -546,7 +2915,7 @@ def delete_album_page(id):
     if not album:
         flash('Album does not exist.')
         return redirect(url_for('admin_page'))
-    return render_template('album/delete_album.html', user=User.query.get(session['user_id']), album=album)
+    return render_template('album/delete_album.html', user=current_user(), album=album)
 
 # Define the route for processing the deletion of an album (admin only)
 @app.route('/album/<int:id>/delete', methods=['POST'])
@@ -556,32 +2925,135 @@ def delete_album_page_post(id):
   if not album:
     flash('Album does not exist.')
     return redirect(url_for('admin_page'))
+  unindex_album(album.id)
+  # the songs of the album go with it, along with their references to stored files
+  for song in album.songs:
+    unindex_song(song.id)
+    release_blobs(song_blobs(song))
+    db.session.delete(song)
+  bump_stat('songs', -len(album.songs))
   db.session.delete(album)
+  bump_stat('albums', -1)
+  bump_catalog(album.id)
   db.session.commit()
+  queue_media_job(collect_blobs_batch)
   flash('Album deleted successfully')
   return redirect(url_for('admin_page'))
 
 # Define the route for adding a song to a playlist (authenticated users only)
 @app.route('/playlist/<int:song_id>/add', methods=['POST'])
 @auth_required
+@write_retry
 def add_to_playlist_page(song_id):
     song = Song.query.get(song_id)
     if not song:
         flash('Song does not exist.')
         return redirect(url_for('index_page'))
-    playlist = Playlist.query.filter_by(userid=session['user_id']).filter_by(songid=song_id).first()
-    if playlist:
-        # Update the existing playlist entry with the new song ID
-        playlist.songid = song.id
-        db.session.commit()
-        flash('Song added to playlist successfully.')
-        return redirect(url_for('index_page'))
-    playlist = Playlist(userid=session['user_id'], songid=song_id)
-    db.session.add(playlist)
+    # add to the chosen playlist, or to the user's first playlist
+    playlist_id = request.form.get('playlist_id', type=int)
+    if playlist_id:
+        playlist = Playlist.query.filter_by(id=playlist_id, userid=session['user_id']).first()
+        if not playlist:
+            flash('Playlist does not exist.')
+            return redirect(url_for('index_page'))
+    else:
+        playlist = default_playlist(session['user_id'])
+    add_playlist_songs(playlist.id, [song.id])
+    mark_changed('user:' + str(session['user_id']))
     db.session.commit()
+    queue_similar_refresh()
+    # the home page suggests songs saved along with this one
+    session['saved_song_id'] = song.id
     flash('Song added to playlist successfully.')
     return redirect(url_for('index_page'))
 
+# Define the route for creating a playlist (authenticated users only)
+@app.route('/playlist/new', methods=['POST'])
+@auth_required
+@write_retry
+def add_playlist_page_post():
+    name = request.form.get('name')
+    if not name:
+        flash('Playlist name can not be empty.')
+        return redirect(url_for('playlists_page'))
+    if len(name) > 50:
+        flash('Playlist name can not be greater than 50 characters.')
+        return redirect(url_for('playlists_page'))
+    playlist = Playlist(userid=session['user_id'], name=name)
+    db.session.add(playlist)
+    mark_changed('user:' + str(session['user_id']))
+    db.session.commit()
+    flash('Playlist created successfully.')
+    return redirect(url_for('playlists_page', playlist_id=playlist.id))
+
+# Define the route for deleting a playlist (authenticated users only)
+@app.route('/playlist/<int:id>/delete', methods=['POST'])
+@auth_required
+@write_retry
+def delete_playlist_page_post(id):
+    playlist = Playlist.query.filter_by(id=id, userid=session['user_id']).first()
+    if not playlist:
+        flash('Playlist does not exist.')
+        return redirect(url_for('playlists_page'))
+    song_ids = db.session.scalars(db.select(PlaylistSong.songid).where(PlaylistSong.playlistid == id)).all()
+    remove_playlist_songs(id, song_ids)
+    db.session.delete(playlist)
+    mark_changed('user:' + str(session['user_id']))
+    db.session.commit()
+    queue_similar_refresh()
+    flash('Playlist deleted successfully.')
+    return redirect(url_for('playlists_page'))
+
+# Define the routes for adding and removing many songs of a playlist at once (authenticated users only)
+# song ids come as repeated song_id fields or one comma separated song_ids field
+def form_song_ids():
+    ids = request.form.getlist('song_id') + (request.form.get('song_ids') or '').split(',')
+    return [int(id) for id in ids if id.strip().isdigit()]
+
+@app.route('/playlist/<int:id>/songs', methods=['POST'])
+@auth_required
+@write_retry
+def add_playlist_songs_page_post(id):
+    playlist = Playlist.query.filter_by(id=id, userid=session['user_id']).first()
+    if not playlist:
+        flash('Playlist does not exist.')
+        return redirect(url_for('playlists_page'))
+    count = add_playlist_songs(id, form_song_ids())
+    mark_changed('user:' + str(session['user_id']))
+    db.session.commit()
+    queue_similar_refresh()
+    flash(str(count) + ' songs added to playlist successfully.')
+    return redirect(url_for('playlists_page', playlist_id=id))
+
+@app.route('/playlist/<int:id>/songs/remove', methods=['POST'])
+@auth_required
+@write_retry
+def remove_playlist_songs_page_post(id):
+    playlist = Playlist.query.filter_by(id=id, userid=session['user_id']).first()
+    if not playlist:
+        flash('Playlist does not exist.')
+        return redirect(url_for('playlists_page'))
+    count = remove_playlist_songs(id, form_song_ids())
+    mark_changed('user:' + str(session['user_id']))
+    db.session.commit()
+    queue_similar_refresh()
+    flash(str(count) + ' songs removed from playlist successfully.')
+    return redirect(url_for('playlists_page', playlist_id=id))
+
+# Define the route for moving a song up or down a playlist (authenticated users only)
+@app.route('/playlist/<int:id>/move/<int:song_id>', methods=['POST'])
+@auth_required
+@write_retry
+def move_playlist_song_page_post(id, song_id):
+    playlist = Playlist.query.filter_by(id=id, userid=session['user_id']).first()
+    if not playlist:
+        flash('Playlist does not exist.')
+        return redirect(url_for('playlists_page'))
+    move_playlist_song(id, song_id, -1 if request.form.get('direction') == 'up' else 1)
+    mark_changed('user:' + str(session['user_id']))
+    db.session.commit()
+    return redirect(url_for('playlists_page', playlist_id=id))
+
 # Define the route for viewing lyrics of a specific song
 @app.route('/song/<int:song_id>/lyrics')
 @auth_required
@@ -590,13 +3062,22 @@ def song_lyrics_page(song_id):
     if not song:
         flash('Song does not exist.')
         return redirect(url_for('index_page'))
-    return render_template('song/open_song.html', user=User.query.get(session['user_id']), song=song, songs=Song.query.all())
+    return render_template('song/open_song.html', user=current_user(), song=song, lyrics=load_lyrics(song), similar=similar_songs(song.id))
 
 # Define the route for viewing user playlists (authenticated users only)
 @app.route('/playlist')
+@conditional_page('catalog', 'user')
 @auth_required
 def playlists_page():
-    return render_template('playlists.html', user=User.query.get(session['user_id']), users=User.query.all(), songs=Song.query.all(), albums=Album.query.all(), playlists=Playlist.query.filter_by(userid=session['user_id']).all())
+    playlists = Playlist.query.filter_by(userid=session['user_id']).order_by(Playlist.id).all()
+    playlist_id = request.args.get('playlist_id', type=int)
+    # show the chosen playlist, or the first one
+    playlist = next((playlist for playlist in playlists if playlist.id == playlist_id), playlists[0] if playlists else None)
+    if not playlist:
+        return render_template('playlists.html', user=current_user(), playlists=playlists, playlist=None, entries=[], playlist_count=0, page={})
+    page = keyset_page(catalog_playlist(playlist.id), PlaylistSong.position)
+    playlist_count = PlaylistSong.query.filter_by(playlistid=playlist.id).count()
+    return render_template('playlists.html', user=current_user(), playlists=playlists, playlist=playlist, entries=page['items'], playlist_count=playlist_count, page=page)
 
 
 '''
@@ -613,34 +3094,49 @@ def playlists_page():
 # Define the route for the creator page
 @app.route('/creator')
 @auth_required
+@write_retry
 def creators_page():
-    user = User.query.get(session['user_id'])
+    user = current_user()
         # Check if the user is not already a creator
     if not user.iscreator:
         # Set the iscreator status to True
         user.iscreator = True
+        bump_stat('creators')
         db.session.commit()
+        invalidate_roles(user.id)
     return render_template('creators.html', user=user)
 
 @app.route('/creator/upload')
 @auth_required
 def upload_song_page():
     album_id = request.args.get('album_id', type=int, default=-1)
-    return render_template('upload_song.html', user=User.query.get(session['user_id']), album=Album.query.get(album_id), albums=Album.query.all())
+    return render_template('upload_song.html', user=current_user(), album=Album.query.get(album_id))
 
 @app.route('/creator/upload', methods=['POST'])
 @auth_required
 def upload_song_page_post():
+    # the audio file is written to disk while the form is parsed, up to the upload cap
+    request.max_content_length = app.config['MAX_UPLOAD_SIZE']
     name = request.form.get('name')
-    songduration_str = request.form.get('songduration')
+    songduration_str = request.form.get('songduration', '')
     songdateofcreation_str = request.form.get('songdateofcreation')
     album_id = request.form.get('album_id', type=int)
-    #checking validity of song details
-    if name == '' or songduration_str == '' or songdateofcreation_str == '' or album_id is None:
+    file = request.files.get('file')
+    if file and not file.filename:
+        file = None
+    extension = os.path.splitext(file.filename)[1].lower() if file else None
+    if file and extension not in media_extensions:
+        flash('Unsupported audio file type.')
+        return redirect(url_for('upload_song_page'))
+    #checking validity of song details, the duration is read from the audio file when left empty
+    if name == '' or (songduration_str == '' and not file) or songdateofcreation_str == '' or album_id is None:
         flash('Song name, duration, date of creation, or album ID cannot be empty.')
         return redirect(url_for('upload_song_page'))
+    if songduration_str == '' and not media_metadata_readable(extension):
+        flash('The duration can not be read from ' + extension + ' files, please enter it.')
+        return redirect(url_for('upload_song_page'))
     try:
-        songduration = datetime.strptime(songduration_str, '%H:%M:%S').time()
+        songduration = datetime.strptime(songduration_str or '00:00:00', '%H:%M:%S').time()
         songdateofcreation = datetime.strptime(songdateofcreation_str, '%Y-%m-%d')
     except ValueError:
         flash('Invalid Song duration or date of creation format.')
@@ -652,11 +3148,160 @@ def upload_song_page_post():
     # storing song information after validity check
     song = Song(songname=name, album_id = album_id, songduration=songduration, songdateofcreation=songdateofcreation)
     db.session.add(song)
+    bump_stat('songs')
+    db.session.flush()
+    if file:
+        song.songaudio_path = store_upload('audio', file, extension)
+    index_song(song.id)
+    bump_catalog(album_id)
     db.session.commit()
+    # duration and other metadata are filled in by the media workers once the response is gone
+    if file:
+        queue_media_job(extract_song_metadata, song.id, song.songaudio_path)
     flash('Song added successfully.')
     return redirect(url_for('upload_song_page', id=album.id))
 
 
+# JSON API
+
+# Raised by API views, answered with a JSON error body
+class ApiError(Exception):
+  def __init__(self, message, status=400):
+    super().__init__(message)
+    self.message = message
+    self.status = status
+
+@app.errorhandler(ApiError)
+def api_error(error):
+  return jsonify({'success': False, 'message': error.message}), error.status
+
+# Define a decorator for API routes that require authentication
+def api_auth_required(func):
+  @wraps(func)
+  def inner(*args, **kwargs):
+    if 'user_id' not in session:
+      raise ApiError('You need to login first.', 401)
+    return func(*args, **kwargs)
+  return inner
+
+# Fields each API resource may project, the first one is the keyset cursor
+api_fields = {
+  'albums': (Album, ['id', 'albumname', 'albumgenre', 'albumartist', 'albumnoofsongs']),
+  'songs': (Song, ['id', 'songname', 'album_id', 'songduration', 'songdateofcreation', 'songlyrics_path', 'songaudio_path']),
+  'genres': (Genre, ['id', 'genrename']),
+  'playlists': (Playlist, ['id', 'name']),
+}
+
+def json_dumps(value):
+  if orjson:
+    return orjson.dumps(value).decode('utf-8')
+  return json.dumps(value, default=str, separators=(',', ':'))
+
+# Columns named by the fields= argument, all fields of the resource when it is missing
+def api_columns(resource):
+  model, names = api_fields[resource]
+  fields = request.args.get('fields')
+  if fields:
+    unknown = [name for name in fields.split(',') if name not in names]
+    if unknown:
+      raise ApiError('Unknown fields: ' + ', '.join(unknown) + '.')
+    names = [name for name in names if name in fields.split(',')]
+  return names, [getattr(model, name) for name in names]
+
+# Keyset window of a list statement from the after= and limit= arguments
+def api_window(statement, cursor):
+  after = request.args.get('after', type=int)
+  limit = request.args.get('limit', type=int)
+  if after is not None:
+    statement = statement.where(cursor > after)
+  statement = statement.order_by(cursor)
+  if limit:
+    statement = statement.limit(limit)
+  return statement
+
+# Stream a JSON list response chunk by chunk while rows are fetched, never building the whole list
+def stream_list(key, names, statement):
+  def generate():
+    yield '{"success":true,"' + key + '":['
+    separator = ''
+    for rows in db.session.execute(statement.execution_options(yield_per=500)).partitions():
+      yield separator + ','.join(json_dumps(dict(zip(names, row))) for row in rows)
+      separator = ','
+    yield ']}'
+  return Response(stream_with_context(generate()), mimetype='application/json')
+
+@app.route('/api/albums')
+@api_auth_required
+def api_albums():
+  names, columns = api_columns('albums')
+  return stream_list('albums', names, api_window(db.select(*columns), Album.id))
+
+@app.route('/api/albums/<int:id>')
+@api_auth_required
+def api_album(id):
+  names, columns = api_columns('albums')
+  album = db.session.execute(db.select(*columns).where(Album.id == id)).first()
+  if not album:
+    raise ApiError('Album does not exist.', 404)
+  songs = db.session.execute(db.select(Song.id, Song.songname, Song.songduration, Song.songdateofcreation).where(Song.album_id == id).order_by(Song.id))
+  album = dict(zip(names, album))
+  album['songs'] = [dict(zip(('id', 'songname', 'songduration', 'songdateofcreation'), song)) for song in songs]
+  return Response(json_dumps({'success': True, 'album': album}), mimetype='application/json')
+
+@app.route('/api/songs')
+@api_auth_required
+def api_songs():
+  names, columns = api_columns('songs')
+  statement = db.select(*columns)
+  album_id = request.args.get('album_id', type=int)
+  if album_id is not None:
+    statement = statement.where(Song.album_id == album_id)
+  return stream_list('songs', names, api_window(statement, Song.id))
+
+@app.route('/api/genres')
+@api_auth_required
+def api_genres():
+  names, columns = api_columns('genres')
+  return stream_list('genres', names, api_window(db.select(*columns), Genre.id))
+
+@app.route('/api/playlists')
+@api_auth_required
+def api_playlists():
+  names, columns = api_columns('playlists')
+  statement = db.select(*columns).where(Playlist.userid == session['user_id'])
+  return stream_list('playlists', names, api_window(statement, Playlist.id))
+
+# songs of a playlist in playlist order, fields= projects the song fields
+@app.route('/api/playlists/<int:id>')
+@api_auth_required
+def api_playlist(id):
+  if not Playlist.query.filter_by(id=id, userid=session['user_id']).first():
+    raise ApiError('Playlist does not exist.', 404)
+  names, columns = api_columns('songs')
+  statement = db.select(PlaylistSong.position, *columns).join(Song, Song.id == PlaylistSong.songid).where(PlaylistSong.playlistid == id)
+  return stream_list('songs', ['position'] + names, api_window(statement, PlaylistSong.position))
+
+# ranked full text search, type=album or type=song
+@app.route('/api/search')
+@api_auth_required
+def api_search():
+  resource = 'albums' if request.args.get('type') == 'album' else 'songs'
+  model = api_fields[resource][0]
+  ids = search_ids('album_search' if resource == 'albums' else 'song_search', request.args.get('q') or '')
+  names, columns = api_columns(resource)
+  rows = {row[0]: row[1:] for row in db.session.execute(db.select(model.id, *columns).where(model.id.in_(ids)))}
+  results = [dict(zip(names, rows[id])) for id in ids if id in rows]
+  return Response(json_dumps({'success': True, resource: results}), mimetype='application/json')
+
+# typeahead for the searchbar, song, album and artist names starting with q, served from the catalog snapshot
+@app.route('/search/suggest')
+@api_auth_required
+def api_suggest():
+  prefix = (request.args.get('q') or '').strip()
+  limit = min(request.args.get('limit', type=int) or app.config['SUGGEST_LIMIT'], app.config['SUGGEST_LIMIT'])
+  suggestions = [{'type': kind, 'id': id, 'name': name} for kind, id, name in catalog_snapshot().suggest(prefix, limit)] if prefix else []
+  return Response(json_dumps({'success': True, 'suggestions': suggestions}), mimetype='application/json')
+
 # Additional routes (commented out for now)
 '''
 @app.route('/admin_login')
@@ -701,7 +3346,378 @@ def upload():
   return render_template('upload.html')
 '''
 
+# Words synthetic catalog names are made of
+seed_words = ['love', 'night', 'blue', 'fire', 'dream', 'city', 'river', 'summer', 'heart', 'road', 'light', 'rain',
+              'gold', 'wild', 'echo', 'shadow', 'star', 'ocean', 'silver', 'storm', 'velvet', 'neon', 'paper', 'stone']
+
+def seed_name(rng, n):
+  return ' '.join(rng.choice(seed_words) for _ in range(rng.randint(1, 3))).title() + ' ' + str(n)
+
+# Generate a synthetic catalog of the given size, songs go through the bulk import pipeline
+@app.cli.command('seed-catalog')
+@click.option('--users', default=1000)
+@click.option('--genres', default=20)
+@click.option('--albums', default=500)
+@click.option('--songs', default=10000)
+@click.option('--playlist-rows', default=50000, help='Songs saved in playlists, spread over the seeded users.')
+@click.option('--seed', default=0, help='Random seed, the same seed gives the same catalog.')
+@click.option('--batch-size', default=10000, help='Rows inserted per transaction.')
+def seed_catalog_command(users, genres, albums, songs, playlist_rows, seed, batch_size):
+  rng = random.Random(seed)
+  start = time.perf_counter()
+  first = (db.session.scalar(db.select(db.func.max(Genre.id))) or 0) + 1
+  genre_names = ['Genre ' + str(n) for n in range(first, first + genres)] or list(db.session.scalars(db.select(Genre.genrename)))
+  first = (db.session.scalar(db.select(db.func.max(Album.id))) or 0) + 1
+  album_keys = [(seed_name(rng, n), 'Artist ' + str(rng.randint(1, max(1, albums // 5)))) for n in range(first, first + albums)]
+  first = (db.session.scalar(db.select(db.func.max(Song.id))) or 0) + 1
+  def records():
+    for name in genre_names:
+      yield {'type': 'genre', 'name': name}
+    for name, artist in album_keys:
+      yield {'type': 'album', 'name': name, 'genre': rng.choice(genre_names), 'artist': artist}
+    for n in range(first, first + songs):
+      name, artist = rng.choice(album_keys)
+      yield {'type': 'song', 'name': seed_name(rng, n), 'album': name, 'artist': artist,
+             'duration': '00:%02d:%02d' % (rng.randint(1, 9), rng.randint(0, 59)), 'date': '%d-%02d-%02d' % (rng.randint(1960, 2024), rng.randint(1, 12), rng.randint(1, 28))}
+  known_genres = set(db.session.scalars(db.select(Genre.genrename)))
+  known_albums = {(name, artist): id for id, name, artist in db.session.execute(db.select(Album.id, Album.albumname, Album.albumartist))}
+  for chunk in chunked(records(), batch_size):
+    import_catalog_chunk(chunk, known_genres, known_albums)
+  click.echo('Catalog seeded in ' + str(round(time.perf_counter() - start, 1)) + ' s')
+  # seeded users all share one precomputed hash of the password 'password'
+  passhash = generate_password_hash('password')
+  first = (db.session.scalar(db.select(db.func.max(User.id))) or 0) + 1
+  for chunk in chunked(range(first, first + users), batch_size):
+    db.session.execute(db.insert(User), [{'username': 'user' + str(n), 'passhash': passhash, 'name': 'User ' + str(n), 'isadmin': False, 'iscreator': n % 10 == 0} for n in chunk])
+    bump_stat('users', len(chunk))
+    bump_stat('creators', len([n for n in chunk if n % 10 == 0]))
+    db.session.commit()
+  click.echo('Users seeded in ' + str(round(time.perf_counter() - start, 1)) + ' s')
+  # one playlist per seeded user, filled with random songs
+  if users and playlist_rows:
+    user_ids = range(first, first + users)
+    db.session.execute(db.insert(Playlist), [{'userid': id, 'name': 'My Playlist'} for id in user_ids])
+    db.session.commit()
+    playlist_ids = dict(db.session.execute(db.select(Playlist.userid, Playlist.id).where(Playlist.userid >= first)).all())
+    max_song = db.session.scalar(db.select(db.func.max(Song.id))) or 0
+    positions = Counter()
+    def playlist_rows_of(count):
+      seen = set()
+      while count and max_song:
+        key = (playlist_ids[rng.choice(user_ids)], rng.randint(1, max_song))
+        if key not in seen:
+          seen.add(key)
+          positions[key[0]] += playlist_gap
+          count -= 1
+          yield {'playlistid': key[0], 'songid': key[1], 'position': positions[key[0]]}
+    for chunk in chunked(playlist_rows_of(playlist_rows), batch_size):
+      db.session.execute(db.insert(PlaylistSong).prefix_with('OR IGNORE'), chunk)
+      db.session.commit()
+    click.echo('Playlists seeded in ' + str(round(time.perf_counter() - start, 1)) + ' s')
+
+# Requests the benchmark drives beside the GET routes: (endpoint, role, url, form data), i makes names unique
+def bench_posts(rng, i, ids, member):
+  song_id = rng.randint(1, ids['song'] or 1)
+  album_id = rng.randint(1, ids['album'] or 1)
+  song_form = {'name': 'Bench Song ' + str(i), 'songduration': '00:03:00', 'songdateofcreation': '2024-01-01', 'album_id': album_id}
+  return [
+    ('login_page_post', None, '/login', {'username': member['username'], 'password': member['password']}),
+    ('register_page_post', None, '/register', {'username': 'bench' + member['run'] + '-' + str(i), 'password': 'password', 'name': 'Bench'}),
+    ('profile_page_post', 'member', '/profile', {'username': member['username'], 'name': 'Bench', 'password': member['password'], 'cpassword': member['password']}),
+    ('add_to_playlist_page', 'member', '/playlist/' + str(song_id) + '/add', {}),
+    ('add_playlist_page_post', 'member', '/playlist/new', {'name': 'Bench ' + str(i)}),
+    ('add_playlist_songs_page_post', 'member', '/playlist/' + str(member['playlist']) + '/songs', {'song_ids': ','.join(str(rng.randint(1, ids['song'] or 1)) for _ in range(10))}),
+    ('remove_playlist_songs_page_post', 'member', '/playlist/' + str(member['playlist']) + '/songs/remove', {'song_ids': str(rng.randint(1, ids['song'] or 1))}),
+    ('move_playlist_song_page_post', 'member', '/playlist/' + str(member['playlist']) + '/move/' + str(song_id), {'direction': rng.choice(['up', 'down'])}),
+    ('upload_song_page_post', 'member', '/creator/upload', song_form),
+    ('add_genre_page_post', 'admin', '/genre/add', {'name': 'Bench Genre ' + member['run'] + '-' + str(i)}),
+    ('add_album_page_post', 'admin', '/album/add', {'name': 'Bench Album ' + str(i), 'genre': 'Bench', 'artist': 'Bench'}),
+    ('add_song_page_post', 'admin', '/song/add-song', song_form),
+    ('edit_song_page_post', 'admin', '/song/' + str(song_id) + '/edit-song', song_form),
+  ]
+
+# Benchmark every route through the Flask test client, reporting latency percentiles, SQL queries and peak RSS as JSON
+# deleting routes and logout are not driven so repeated runs keep the catalog intact
+@app.cli.command('bench')
+@click.option('--requests', 'count', default=50, help='Requests per route.')
+@click.option('--threads', default=1, help='Threads sending requests at the same time.')
+@click.option('--seed', default=0)
+@click.option('--output', default=None, help='JSON file to write, printed when omitted.')
+def bench_command(count, threads, seed, output):
+  rng = random.Random(seed)
+  ids = {table: db.session.scalar(db.text('SELECT MAX(id) FROM ' + table)) or 0 for table in ('genre', 'album', 'song', 'playlist')}
+  # a fresh member with a playlist, the admin
+  run = str(int(time.time()))
+  member = {'username': 'bench' + run, 'password': 'password', 'run': run}
+  app.test_client().post('/register', data={'username': member['username'], 'password': member['password'], 'name': 'Bench'})
+  member_id = User.query.filter_by(username=member['username']).first().id
+  member['playlist'] = default_playlist(member_id).id
+  db.session.commit()
+  admin_id = User.query.filter_by(isadmin=True).first().id
+  queries = threading.local()
+  def count_query(*args):
+    queries.count = getattr(queries, 'count', 0) + 1
+  skipped = {'static', 'logout_page'}
+  gets = [rule for rule in app.url_map.iter_rules() if 'GET' in rule.methods and rule.endpoint not in skipped]
+  def get_url(rule):
+    # the table an id refers to comes from the first path segment, e.g. /album/<id> or /api/albums/<id>
+    parts = [part for part in rule.rule.split('/') if part and part != 'api']
+    table = 'playlist' if rule.endpoint == 'playlists_page' or not parts else parts[0].rstrip('s')
+    values = {}
+    for name in rule.arguments:
+      # playlists are only visible to their owner
+      if table == 'playlist' and name == 'id':
+        values[name] = member['playlist']
+      else:
+        values[name] = rng.randint(1, ids['song' if name == 'song_id' or table not in ids else table] or 1)
+    return rule.build(values)[1]
+  def send(role, method, url, data):
+    client = app.test_client()
+    if role:
+      with client.session_transaction() as client_session:
+        client_session['user_id'] = admin_id if role == 'admin' else member_id
+    queries.count = 0
+    start = time.perf_counter()
+    response = client.open(url, method=method, data=data)
+    # read streamed bodies to the end so their queries are timed too
+    response.get_data()
+    response.close()
+    return time.perf_counter() - start, queries.count, response.status_code
+  results = {}
+  def run_route(name, requests):
+    timings, counts, statuses = [], [], Counter()
+    lock = threading.Lock()
+    def work(part):
+      for request_args in part:
+        elapsed, query_count, status = send(*request_args)
+        with lock:
+          timings.append(elapsed)
+          counts.append(query_count)
+          statuses[status] += 1
+    workers = [threading.Thread(target=work, args=(requests[n::threads],)) for n in range(threads)]
+    for worker in workers:
+      worker.start()
+    for worker in workers:
+      worker.join()
+    timings.sort()
+    results[name] = {
+      'requests': len(timings),
+      'p50_ms': round(percentile(timings, 50) * 1000, 3),
+      'p95_ms': round(percentile(timings, 95) * 1000, 3),
+      'p99_ms': round(percentile(timings, 99) * 1000, 3),
+      'queries_mean': round(sum(counts) / len(counts), 2),
+      'queries_max': max(counts),
+      'status': dict(statuses),
+    }
+    click.echo(name + ': p50 ' + str(results[name]['p50_ms']) + ' ms, p99 ' + str(results[name]['p99_ms']) + ' ms, ' + str(results[name]['queries_mean']) + ' queries', err=True)
+  event.listen(db.engine, 'before_cursor_execute', count_query)
+  try:
+    for rule in gets:
+      for role in ('member', 'admin'):
+        run_route(rule.endpoint + ' [' + role + ']', [(role, 'GET', get_url(rule), None) for _ in range(count)])
+    posts = {}
+    for i in range(count):
+      for endpoint, role, url, data in bench_posts(rng, i, ids, member):
+        posts.setdefault(endpoint, []).append((role, 'POST', url, data))
+    for endpoint, requests in posts.items():
+      run_route(endpoint, requests)
+  finally:
+    event.remove(db.engine, 'before_cursor_execute', count_query)
+  try:
+    commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=app.root_path).stdout.strip()
+  except OSError:
+    commit = None
+  report = {
+    'commit': commit,
+    'threads': threads,
+    'catalog': {table: db.session.execute(db.text('SELECT COUNT(*) FROM ' + table)).scalar() for table in ('user', 'genre', 'album', 'song', 'playlist_song')},
+    # ru_maxrss is in kilobytes on Linux
+    'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    'routes': results,
+  }
+  if output:
+    with open(output, 'w') as file:
+      json.dump(report, file, indent=2)
+  else:
+    click.echo(json.dumps(report, indent=2))
+
+# A registered member for a benchmark run, returns its id
+def bench_member(username, password):
+  app.test_client().post('/register', data={'username': username, 'password': password, 'name': 'Bench'})
+  return User.query.filter_by(username=username).first().id
+
+# Test client signed in as a user, or signed out for None
+def bench_client(user_id):
+  client = app.test_client()
+  if user_id:
+    with client.session_transaction() as client_session:
+      client_session['user_id'] = user_id
+  return client
+
+# Run send() in a loop on background threads until the returned stop function is called,
+# stop() joins them and returns the statuses they counted and the seconds they ran
+def bench_load(threads, send):
+  statuses = Counter()
+  lock = threading.Lock()
+  done = threading.Event()
+  def work():
+    while not done.is_set():
+      status = send()
+      with lock:
+        statuses[status] += 1
+  workers = [threading.Thread(target=work) for _ in range(threads)]
+  start = time.perf_counter()
+  for worker in workers:
+    worker.start()
+  def stop():
+    done.set()
+    for worker in workers:
+      worker.join()
+    return statuses, time.perf_counter() - start
+  return stop
+
+# p50 / p99 milliseconds of count GETs of each url by one client
+def bench_timings(client, urls, count):
+  timings = {}
+  for url in urls:
+    values = []
+    for _ in range(count):
+      start = time.perf_counter()
+      client.get(url).get_data()
+      values.append(time.perf_counter() - start)
+    values.sort()
+    timings[url] = {'p50_ms': round(percentile(values, 50) * 1000, 3), 'p99_ms': round(percentile(values, 99) * 1000, 3)}
+  return timings
+
+# Time other routes while threads flood /login, without a flood, with hashing on the request threads and with the
+# hashing pool, reporting login throughput, logins turned away by the pool's backpressure and the route latencies
+@app.cli.command('bench-login-flood')
+@click.option('--threads', default=8, help='Threads posting logins.')
+@click.option('--requests', 'count', default=50, help='Timed requests per route and phase.')
+@click.option('--output', default=None, help='JSON file to write, printed when omitted.')
+def bench_login_flood_command(threads, count, output):
+  run = str(int(time.time()))
+  member = {'username': 'flood' + run, 'password': 'password'}
+  member_id = bench_member(member['username'], member['password'])
+  urls = ['/', '/?parameter=song&search=a', '/playlist', '/profile']
+  def login():
+    response = bench_client(None).post('/login', data=member)
+    # a signed in member goes to the index, a busy pool sends the form back
+    return 'signed in' if response.headers.get('Location') == '/' else 'turned away'
+  pool_workers = app.config['HASH_WORKERS']
+  phases = {}
+  try:
+    for phase, workers in (('no flood', None), ('flood, hashing inline', 0), ('flood, hashing pool', pool_workers)):
+      stop = None
+      if workers is not None:
+        app.config['HASH_WORKERS'] = workers
+        stop = bench_load(threads, login)
+      timings = bench_timings(bench_client(member_id), urls, count)
+      phases[phase] = {'routes': timings}
+      if stop:
+        statuses, seconds = stop()
+        phases[phase]['logins'] = dict(statuses)
+        phases[phase]['logins_per_s'] = round(statuses['signed in'] / seconds, 1)
+      click.echo(phase + ': ' + ', '.join(url + ' p99 ' + str(timing['p99_ms']) + ' ms' for url, timing in timings.items()), err=True)
+  finally:
+    app.config['HASH_WORKERS'] = pool_workers
+  report = {'threads': threads, 'hash_workers': pool_workers, 'hash_queue_depth': app.config['HASH_QUEUE_DEPTH'], 'phases': phases}
+  if output:
+    with open(output, 'w') as file:
+      json.dump(report, file, indent=2)
+  else:
+    click.echo(json.dumps(report, indent=2))
+
+# SQLite's own defaults, the engine profile the mixed benchmark compares against
+sqlite_default_pragmas = {'journal_mode': 'DELETE', 'synchronous': 'FULL', 'cache_size': -2000, 'mmap_size': 0}
+
+# Readers on index_page mixed with writers on add_to_playlist_page, once with SQLite's defaults and a single write
+# attempt and once with SQLITE_PRAGMAS and WRITE_RETRIES, reporting the throughput of each side, the locked errors
+# SQLite raised (retried ones included) and the requests that failed
+@app.cli.command('bench-mixed')
+@click.option('--readers', default=8, help='Threads reading the index page.')
+@click.option('--writers', default=4, help='Threads adding songs to playlists, each as its own member.')
+@click.option('--seconds', default=5.0, help='Duration of each phase.')
+@click.option('--output', default=None, help='JSON file to write, printed when omitted.')
+def bench_mixed_command(readers, writers, seconds, output):
+  run = str(int(time.time()))
+  reader_id = bench_member('mixed' + run, 'password')
+  writer_ids = [bench_member('mixed' + run + '-' + str(n), 'password') for n in range(writers)]
+  max_song = db.session.scalar(db.select(db.func.max(Song.id))) or 1
+  locked = Counter()
+  def count_locked(context):
+    if 'database is locked' in str(context.original_exception):
+      locked['errors'] += 1
+  def read():
+    return bench_client(reader_id).get('/').status_code
+  def write():
+    return bench_client(random.choice(writer_ids)).post('/playlist/' + str(random.randint(1, max_song)) + '/add').status_code
+  pragmas, retries = app.config['SQLITE_PRAGMAS'], app.config['WRITE_RETRIES']
+  phases = {}
+  try:
+    for phase, profile in (('defaults', (sqlite_default_pragmas, 1)), ('engine profile', (pragmas, retries))):
+      app.config['SQLITE_PRAGMAS'], app.config['WRITE_RETRIES'] = profile
+      # pooled connections ran the pragmas of the last profile
+      db.session.remove()
+      db.engine.dispose()
+      locked.clear()
+      event.listen(db.engine, 'handle_error', count_locked)
+      try:
+        stop_readers = bench_load(readers, read)
+        stop_writers = bench_load(writers, write)
+        time.sleep(seconds)
+        writes, write_seconds = stop_writers()
+        reads, read_seconds = stop_readers()
+      finally:
+        event.remove(db.engine, 'handle_error', count_locked)
+      phases[phase] = {
+        'reads_per_s': round(sum(reads.values()) / read_seconds, 1),
+        'writes_per_s': round(sum(writes.values()) / write_seconds, 1),
+        'locked_errors': locked['errors'],
+        'failed_reads': sum(count for status, count in reads.items() if status >= 500),
+        'failed_writes': sum(count for status, count in writes.items() if status >= 500),
+      }
+      click.echo(phase + ': ' + str(phases[phase]['reads_per_s']) + ' reads/s, ' + str(phases[phase]['writes_per_s']) + ' writes/s, '
+                 + str(locked['errors']) + ' locked errors', err=True)
+  finally:
+    app.config['SQLITE_PRAGMAS'], app.config['WRITE_RETRIES'] = pragmas, retries
+    db.session.remove()
+    db.engine.dispose()
+  report = {'readers': readers, 'writers': writers, 'seconds': seconds, 'sqlite_pragmas': pragmas, 'write_retries': retries, 'phases': phases}
+  if output:
+    with open(output, 'w') as file:
+      json.dump(report, file, indent=2)
+  else:
+    click.echo(json.dumps(report, indent=2))
+
+# Application factory, binds the database and wires the engine profile, metrics, compression and template cache
+# onto the module's app once per process (the routes stay on it, templates use their plain endpoint names).
+# Importing the module doesn't call it, run the app with flask --app app:create_app or gunicorn 'app:create_app()'.
+# Nothing here touches the database, schema and seed data come from flask init-db / flask bootstrap or the
+# first request. config overrides settings on the first call, later calls return the app as it is
+def create_app(config=None):
+  global play_buffer
+  if 'sqlalchemy' in app.extensions:
+    if config:
+      raise RuntimeError('create_app() already ran in this process, its settings can no longer be changed.')
+    return app
+  if config:
+    app.config.update(config)
+  play_buffer = deque(maxlen=app.config['PLAY_BUFFER_SIZE'])
+  db.init_app(app)
+  with app.app_context():
+    event.listen(db.engine, 'connect', set_sqlite_pragmas)
+    if app.config['METRICS_ENABLED']:
+      install_metrics()
+  if app.config['AUTO_INIT_DB']:
+    app.before_request(ensure_database)
+  if app.config['TEMPLATE_CACHE_FOLDER']:
+    os.makedirs(app.config['TEMPLATE_CACHE_FOLDER'], exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['TEMPLATE_CACHE_FOLDER'])
+  app.wsgi_app = GzipMiddleware(app.wsgi_app)
+  return app
+
 # Start the Flask application
 if __name__ == "__main__":
-  app.run()
+  create_app().run()
 #    app.run(host='localhost', port=5000)